@@ -14,14 +14,31 @@
 #   for i in range(0, len(value)):
 #      print(mya.time_epics_to_string(time[i]), value[i])
 
+import os
 import math
+import json
+import zlib
+import time
+import sqlite3
+import struct
 import datetime
-import pytz
-import MySQLdb
 import array
-import ROOT
 import re
+import sys
 import bisect
+import fnmatch
+import itertools
+import threading
+import functools
+import importlib
+import contextlib
+import collections
+import concurrent.futures
+
+try:
+   import numpy
+except ImportError:
+   numpy = None
 
 dbname = "archive"
 dbproxy = "gluey.phys.uconn.edu"
@@ -42,14 +59,203 @@ port = {'opsmya0': 63306,
         'hstmya1': 63319,
        }
 
+# Connection pools to the archive servers, indexed by host name,
+# each holding at most pool_size open connections. Fetches for
+# different hosts, or batches of channels on the same host, run
+# concurrently in a thread pool of max_workers threads.
 db = {}
+pool_size = 4
+max_workers = 16
 
-tzlocal = pytz.timezone("America/New_York")
+# Local time zone of the archive, used by the time conversion
+# functions. The pytz time zone object is built on first use and
+# is also available as mya.tzlocal.
+timezone = "America/New_York"
 
 opsmya_start = 0x5a8e08000000000
 epics_second = (1 << 28)
 epics_cache = {'mya descriptors': {}}
 
+# Set use_arrays = True to have fetch() return, and series_cache hold,
+# numpy int64 time and float64 value arrays instead of python lists.
+# Cache hits then return views into the cached arrays without copying,
+# so callers must not modify the returned arrays in place. Call
+# series_cache.clear() after changing this setting.
+use_arrays = False
+
+# Default number of rows per chunk returned by stream().
+stream_chunksize = 100000
+
+# How mya reports warnings and progress messages. With log_mode "text"
+# they are printed to stdout as "mya.<source> <level>: <message>", with
+# "json" they are written to log_stream (default stderr) as one json
+# object per line, including any structured fields of the message,
+# and with "off" they are dropped.
+log_mode = "text"
+log_stream = None
+
+def report(source, level, text, **fields):
+   """
+   Issue a message from mya function source at the given level (info,
+   warning or error), in the form selected by log_mode. Keyword fields
+   are included in json mode for machine consumption.
+   """
+   if log_mode == "text":
+      print("mya.{0} {1}: {2}".format(source, level, text))
+   elif log_mode == "json":
+      record = {'time': time.time(), 'source': source, 'level': level,
+                'message': text}
+      record.update(fields)
+      stream = log_stream or sys.stderr
+      stream.write(json.dumps(record, default=str) + "\n")
+      stream.flush()
+
+class Metrics:
+   """
+   Counters describing the archive traffic and cache behavior of mya,
+   shared by all threads. A snapshot() returns them as a dict with keys
+      hosts - per archive host, the number of queries, errors, rows and
+              estimated bytes transferred, the total query time in s
+              and a histogram of query latencies, with bin upper edges
+              in ms given by latency_buckets (and a last overflow bin)
+      cache - counts of series_cache requests that were a hit, a miss,
+              or a partial hit needing only the missing pieces, and the
+              cache size in bytes and channels
+      queries - per search_ranges query string, the number of calls,
+              variables fetched, ranges produced, recursive evaluations
+              (ranges_nested only) and total evaluation time in s, for
+              the max_queries most recently used query strings
+   Attribute changes counts the updates made to the counters, so that
+   a process publishing its snapshot can tell when it is out of date.
+   Snapshots from several processes are combined with merge_snapshots().
+   """
+
+   latency_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+   max_queries = 256
+
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.changes = 0
+      self.reset()
+
+   def reset(self):
+      """
+      Set all counters back to zero.
+      """
+      with self.lock:
+         self.changes += 1
+         self.hosts = {}
+         self.cache = {'hit': 0, 'miss': 0, 'partial': 0}
+         self.queries = collections.OrderedDict()
+
+   def record_query(self, host, elapsed, rows=0, nbytes=0, error=False):
+      ms = elapsed * 1000
+      with self.lock:
+         self.changes += 1
+         entry = self.hosts.get(host)
+         if entry is None:
+            entry = self.hosts[host] = {
+                       'queries': 0, 'errors': 0, 'rows': 0, 'bytes': 0,
+                       'time': 0., 'latency': [0] * (len(self.latency_buckets)
+                                                     + 1)}
+         entry['queries'] += 1
+         entry['errors'] += int(error)
+         entry['rows'] += rows
+         entry['bytes'] += nbytes
+         entry['time'] += elapsed
+         entry['latency'][bisect.bisect_left(self.latency_buckets, ms)] += 1
+
+   def record_cache(self, outcome):
+      with self.lock:
+         self.changes += 1
+         self.cache[outcome] += 1
+
+   def record_search(self, query, **counts):
+      with self.lock:
+         self.changes += 1
+         entry = self.queries.get(query)
+         if entry is None:
+            entry = self.queries[query] = {'calls': 0, 'fetches': 0,
+                                           'ranges': 0, 'recursion': 0,
+                                           'time': 0.}
+            while len(self.queries) > self.max_queries:
+               self.queries.popitem(last=False)
+         else:
+            self.queries.move_to_end(query)
+         for key in counts:
+            entry[key] += counts[key]
+
+   def snapshot(self):
+      """
+      Return a copy of the counters as a dict, see the class description.
+      """
+      with self.lock:
+         cache = dict(self.cache)
+         cache['bytes'] = series_cache.nbytes
+         cache['channels'] = len(series_cache.channels)
+         requests = cache['hit'] + cache['miss'] + cache['partial']
+         cache['hit_ratio'] = cache['hit'] / requests if requests else None
+         return {'latency_buckets': list(self.latency_buckets),
+                 'hosts': {host: dict(entry, latency=list(entry['latency']))
+                           for host, entry in self.hosts.items()},
+                 'cache': cache,
+                 'queries': {query: dict(entry)
+                             for query, entry in self.queries.items()}}
+
+metrics = Metrics()
+
+def merge_snapshots(snapshots):
+   """
+   Combine a list of Metrics snapshots, such as those of several worker
+   processes, into one with the same keys, where every count and time
+   is the sum over the snapshots and the cache hit ratio is recomputed.
+   """
+   merged = {'latency_buckets': list(Metrics.latency_buckets), 'hosts': {},
+             'cache': {'hit': 0, 'miss': 0, 'partial': 0, 'bytes': 0,
+                       'channels': 0},
+             'queries': {}}
+   for snapshot in snapshots:
+      for host, entry in snapshot['hosts'].items():
+         total = merged['hosts'].get(host)
+         if total is None:
+            merged['hosts'][host] = dict(entry, latency=list(entry['latency']))
+            continue
+         for key in ('queries', 'errors', 'rows', 'bytes', 'time'):
+            total[key] += entry[key]
+         total['latency'] = [a + b for a, b in zip(total['latency'],
+                                                   entry['latency'])]
+      for key in merged['cache']:
+         merged['cache'][key] += snapshot['cache'][key]
+      for query, entry in snapshot['queries'].items():
+         total = merged['queries'].setdefault(query, dict.fromkeys(entry, 0))
+         for key in entry:
+            total[key] += entry[key]
+   cache = merged['cache']
+   requests = cache['hit'] + cache['miss'] + cache['partial']
+   cache['hit_ratio'] = cache['hit'] / requests if requests else None
+   return merged
+
+# Optional profiling hook around every archive query, called as
+# query_hook(host, sql) to obtain a context manager that is entered
+# just before the query is sent and exited once its rows are read,
+# for example to run a profiler or tracer over each query.
+query_hook = None
+
+def _query_context(host, sql):
+   if query_hook is None:
+      return contextlib.nullcontext()
+   return query_hook(host, sql)
+
+def _rows_nbytes(description, rows):
+   """
+   Estimate the number of bytes in query result rows, counting 8 bytes
+   per numeric column, using the first row to tell the column types.
+   """
+   if not rows:
+      return 0
+   width = sum(len(x) if isinstance(x, (str, bytes)) else 8 for x in rows[0])
+   return width * len(rows)
+
 def lookup(varname, deployment="ops"):
    """
    Fetches the following information from the EPICS archive directory
@@ -68,27 +274,84 @@ def lookup(varname, deployment="ops"):
    """
    if varname in epics_cache['mya descriptors']:
       return epics_cache['mya descriptors'][varname]
+   if directory is not None and directory.deployment == deployment:
+      descr = directory.lookup(varname)
+      if descr is not None:
+         epics_cache['mya descriptors'][varname] = descr
+         return descr
    if deployment == "ops":
       host = "opsmya0"
    elif deployment == "history":
       host = "hstmya1"
    else:
-      print("mya.lookup warning: unknown archive deployment {0},"
-            "cannot continue!".format(deployment))
+      report("lookup", "warning", "unknown archive deployment {0},"
+             "cannot continue!".format(deployment), deployment=deployment)
       return {}
-   if not host in db:
-      connect(host)
-   cur = db[host].cursor()
-   cur.execute("select * from channels where name = '{0}'".format(varname))
-   heads = cur.description
+   if archive_store is not None:
+      descr = archive_store.lookup(varname, deployment)
+      if descr:
+         epics_cache['mya descriptors'][varname] = descr
+         return descr
+   heads, rows = execute(host, "select * from channels where name = %s",
+                         (varname,))
    descr = {}
-   for row in cur.fetchall():
+   for row in rows:
       for i in range(0, len(heads)):
          descr[heads[i][0]] = row[i]
    epics_cache['mya descriptors'][varname] = descr
+   if archive_store is not None and descr:
+      archive_store.save_descriptor(varname, deployment, descr)
    return descr
 
-def fetch(descr, t0, dt=0, cond=None):
+def lookup_many(varnames, deployment="ops"):
+   """
+   Same as lookup, but for a list of variable names, resolving all
+   of those not already known in a single query to the archive
+   directory. Returns a dict mapping each name to its descriptor,
+   or to {} for names that are not found.
+   """
+   descriptors = epics_cache['mya descriptors']
+   missing = []
+   for varname in varnames:
+      if varname in descriptors or varname in missing:
+         continue
+      if directory is not None and directory.deployment == deployment:
+         descr = directory.lookup(varname)
+         if descr is not None:
+            descriptors[varname] = descr
+            continue
+      if archive_store is not None:
+         descr = archive_store.lookup(varname, deployment)
+         if descr:
+            descriptors[varname] = descr
+            continue
+      missing.append(varname)
+   if len(missing) > 0:
+      if deployment == "ops":
+         host = "opsmya0"
+      elif deployment == "history":
+         host = "hstmya1"
+      else:
+         report("lookup_many", "warning", "unknown archive deployment {0},"
+                "cannot continue!".format(deployment), deployment=deployment)
+         return {varname: descriptors.get(varname, {})
+                 for varname in varnames}
+      heads, rows = execute(host, "select * from channels where name in"
+                            " ({0})".format(",".join(["%s"] * len(missing))),
+                            missing)
+      for row in rows:
+         descr = {}
+         for i in range(0, len(heads)):
+            descr[heads[i][0]] = row[i]
+         descriptors[descr['name']] = descr
+         if archive_store is not None:
+            archive_store.save_descriptor(descr['name'], deployment, descr)
+      for varname in missing:
+         if not varname in descriptors:
+            descriptors[varname] = {}
+   return {varname: descriptors[varname] for varname in varnames}
+
+def fetch(descr, t0, dt=0, cond=None, npoints=None):
    """
    Fetch data for the EPICS variable described in descr starting at
    time t0 (EPICS time) and going forward dt seconds. The values are
@@ -96,92 +359,550 @@ def fetch(descr, t0, dt=0, cond=None):
    the time that value was recorded. If dt is not specified then it defaults
    to zero, and just one value is returned, together with its time. Note
    that the returned time will be less than or equal to the requested t0.
+   The arrays are python lists, or numpy arrays if mya.use_arrays is set.
    A query condition may be provided as a logical expression in input
    variable cond, in which case only time periods that satisfy the
-   logical condition are included in the output.
+   logical condition are included in the output. If npoints is given,
+   the output is reduced to at most about npoints samples using
+   decimate(), which is enough to draw the series at that resolution.
    """
    if isinstance(t0, str):
       t0 = time_string_to_epics(t0)
-   t1 = int(t0 + dt * epics_second)
-   archive = "ops"
+   t0 = int(t0)
+   t1 = t0 + int(dt * epics_second)
+   descr = _resolve(descr, t0, "fetch")
+   if not descr:
+      return [], []
+   values, times = series_cache.get(descr['name'], t0, t1,
+                                    lambda ta, tb: load_series(descr, ta, tb))
+   values, times = filter_cond(values, times, cond)
+   if npoints:
+      return decimate(values, times, npoints, t0, t1)
+   return values, times
+
+def _resolve(descr, t0, caller):
+   """
+   Return the descriptor for descr, which may be a descriptor already
+   or a variable name to look up in the archive that holds time t0,
+   or None with a warning if the variable is not found.
+   """
    if isinstance(descr, dict):
-      host = descr['host']
+      return descr
+   if t0 < opsmya_start:
+      descriptor = lookup(descr, deployment="history")
    else:
-      if t0 < opsmya_start:
-         ops = "history"
-         descriptor = lookup(descr, deployment="history")
-      else:
-         ops = "ops"
-         descriptor = lookup(descr)
-      if 'host' in descriptor:
-         descr = descriptor
-         host = descr['host']
-      else:
-         print("mya.fetch warning: epics variable {0} not found".format(descr))
-         return [], []
+      descriptor = lookup(descr)
+   if 'host' in descriptor:
+      return descriptor
+   report(caller, "warning", "epics variable {0} not found".format(descr),
+          channel=descr)
+   return None
+
+def stream(descr, t0, dt=0, chunksize=None):
+   """
+   Generator version of fetch, yielding the same series as a sequence
+   of values, times chunks of at most chunksize samples each (default
+   stream_chunksize), as they arrive from the archive server. The data
+   are read with a server-side cursor on a connection of their own
+   and are not added to the cache, so memory use stays bounded by the
+   chunk size however long the interval. If the interval is already
+   cached, the chunks are served from the cache instead.
+   """
+   if isinstance(t0, str):
+      t0 = time_string_to_epics(t0)
+   t0 = int(t0)
+   t1 = t0 + int(dt * epics_second)
+   chunksize = chunksize or stream_chunksize
+   descr = _resolve(descr, t0, "stream")
+   if not descr:
+      return
+   if len(series_cache.missing(descr['name'], t0, t1)) == 0:
+      values, times = series_cache.get(descr['name'], t0, t1, None)
+      for i in range(0, len(times), chunksize):
+         yield values[i:i + chunksize], times[i:i + chunksize]
+      return
+   host = descr['host']
+   table = "table_{0}".format(descr['chan_id'])
+   heads, rows = execute(host, "select time from {0}".format(table) +
+                         " where time <= {0}".format(t0) +
+                         " order by time desc limit 1")
+   tini = rows[0][0] if rows else t0
+   con = connect(host)
+   elapsed = 0
+   nrows = 0
+   try:
+      sql = ("select time,val1 from {0}".format(table) +
+             " where time >= {0} and time <= {1}".format(tini, t1) +
+             " order by time")
+      with _query_context(host, sql):
+         tstart = time.perf_counter()
+         cur = con.cursor(backend('db').stream_cursor)
+         cur.execute(sql)
+         while True:
+            rows = cur.fetchmany(chunksize)
+            elapsed += time.perf_counter() - tstart
+            if not rows:
+               break
+            nrows += len(rows)
+            yield _rows_to_series(rows)
+            tstart = time.perf_counter()
+         cur.close()
+   finally:
+      con.close()
+      metrics.record_query(host, elapsed, nrows, nrows * 16)
+
+def filter_stream(chunks, cond, t0, t1, chunksize=None):
+   """
+   Streaming version of filter_cond, applied to a sequence of values,
+   times chunks covering [t0, t1] such as stream() yields. The query
+   condition is itself evaluated in streaming mode, with the given
+   chunksize, so that memory use stays bounded. As in filter_cond, it
+   is evaluated from the time of the first sample, which is the one in
+   effect at t0 and may be earlier, up to t1.
+   """
+   ranges = None
+   for values, times in chunks:
+      if len(times) == 0:
+         continue
+      if ranges is None:
+         ranges = compile_query(cond).find(times[0], t1, chunksize=chunksize
+                                           or stream_chunksize)
+         r = next(ranges, None)
+      accepted = []
+      while r is not None and r[0] <= times[-1]:
+         accepted.append(r)
+         if r[1] > times[-1]:
+            break
+         r = next(ranges, None)
+      yield select_ranges(values, times, [a[0] for a in accepted],
+                                         [a[1] for a in accepted])
+      if r is None:
+         return
+
+def fetch_binned(descr, t0, dt, nbins=None, binwidth=None):
+   """
+   Fetch data for the EPICS variable described in descr, as for fetch,
+   and summarize them in nbins equal time bins spanning dt seconds, or
+   in bins of binwidth seconds. See bin_series() for the result.
+   """
+   if isinstance(t0, str):
+      t0 = time_string_to_epics(t0)
+   t0 = int(t0)
+   t1 = t0 + int(dt * epics_second)
+   if not nbins:
+      nbins = max(int(math.ceil(dt / binwidth)), 1)
+      t1 = t0 + int(nbins * binwidth * epics_second)
+   values, times = fetch(descr, t0, (t1 - t0) / epics_second)
+   return bin_series(values, times, t0, t1, nbins)
+
+def fetch_rollup(descr, t0, dt, nbins=None, binwidth=None):
+   """
+   Same as fetch_binned, but answered from the rollup bins of the local
+   archive store, so that summaries of long intervals need not read
+   every sample. The coarsest width in rollup_widths that fits in the
+   requested bin width is used, and the bins are rounded to multiples
+   of it, so they may be a little wider than requested and start up
+   to one rollup width before t0. Rollup bins that are not stored yet
+   are computed from the samples, which are fetched through the store
+   so that the bins are stored for next time. Without a store open, or
+   for bins narrower than all rollup widths, this falls back to
+   fetch_binned. The result has the keys of bin_series() plus
+      integral - time integral of the value over the bin, in value*s
+   """
+   if isinstance(t0, str):
+      t0 = time_string_to_epics(t0)
+   t0 = int(t0)
+   if not binwidth:
+      binwidth = dt / nbins
+   widths = [width for width in rollup_widths if width <= binwidth]
+   if archive_store is None or len(widths) == 0:
+      result = fetch_binned(descr, t0, dt, nbins, binwidth)
+      result['integral'] = [m * d if d > 0 else 0.
+                            for m, d in zip(result['mean'],
+                                            result['duration'])]
+      if numpy is not None:
+         result['integral'] = numpy.array(result['integral'])
+      return result
+   width = max(widths)
+   w = width * epics_second
+   group = int(binwidth // width)
+   k0 = t0 // w
+   k1 = -(-(t0 + int(dt * epics_second)) // w)
+   nout = max(-(-(k1 - k0) // group), 1)
+   k1 = k0 + nout * group
+   descr = _resolve(descr, t0, "fetch_rollup")
+   nan = float('nan')
+   if not descr:
+      # unknown channel, every bin is empty
+      rows = [[0, nan, nan, 0., 0., nan]] * (k1 - k0)
+   else:
+      rows = _rollup_rows(descr, k0, k1, width)
+   result = {'time': [], 'min': [], 'max': [], 'mean': [], 'last': [],
+             'count': [], 'duration': [], 'integral': []}
+   for n in range(0, nout):
+      block = rows[n * group:(n + 1) * group]
+      vmin = [row[1] for row in block if row[1] == row[1]]
+      vmax = [row[2] for row in block if row[2] == row[2]]
+      integral = sum(row[3] for row in block)
+      duration = sum(row[4] for row in block)
+      result['time'].append((k0 + n * group) * w)
+      result['min'].append(min(vmin) if vmin else nan)
+      result['max'].append(max(vmax) if vmax else nan)
+      result['mean'].append(integral / duration if duration > 0 else nan)
+      result['last'].append(block[-1][5])
+      result['count'].append(sum(row[0] for row in block))
+      result['duration'].append(duration)
+      result['integral'].append(integral)
+   if numpy is not None:
+      result = {key: numpy.array(result[key]) for key in result}
+   return result
+
+def _rollup_rows(descr, k0, k1, width):
+   """
+   Return the rollup bins k0 <= k < k1 of the given width for channel
+   descr as a list of [count, min, max, integral, duration, last] rows,
+   taken from the archive store where they are stored, and computed
+   from the fetched samples where they are not.
+   """
+   w = width * epics_second
+   stored = archive_store.rollup(descr, k0 * w, k1 * w, width)
+   nan = float('nan')
+   rows = []
+   k = k0
+   while k < k1:
+      if k * w in stored:
+         rows.append([nan if x is None else x for x in stored[k * w]])
+         k += 1
+         continue
+      kend = k
+      while kend < k1 and not kend * w in stored:
+         kend += 1
+      values, times = fetch(descr, k * w, (kend - k) * width)
+      bins = bin_series(values, times, k * w, kend * w, kend - k)
+      for j in range(0, kend - k):
+         duration = float(bins['duration'][j])
+         rows.append([int(bins['count'][j]), float(bins['min'][j]),
+                      float(bins['max'][j]),
+                      float(bins['mean'][j]) * duration if duration > 0
+                      else 0., duration, float(bins['last'][j])])
+      k = kend
+   return rows
+
+def fetch_many(varnames, t0, dt=0, cond=None):
+   """
+   Same as fetch, but for a list of EPICS variable names. Descriptors
+   are resolved with a single lookup_many() query, and the data that
+   are not already cached are pulled from the archive hosts using
+   fetch_tables(), with the channels on each host split into up to
+   pool_size batches, and all batches running concurrently. Returns a
+   dict mapping each name to its values, times pair, in the order of
+   varnames.
+   """
+   if isinstance(t0, str):
+      t0 = time_string_to_epics(t0)
+   t0 = int(t0)
+   t1 = t0 + int(dt * epics_second)
+   deployment = "history" if t0 < opsmya_start else "ops"
+   descrs = lookup_many(varnames, deployment)
+   requests = {}
+   for varname in descrs:
+      descr = descrs[varname]
+      if not 'host' in descr:
+         report("fetch_many", "warning", "epics variable {0} not found"
+                .format(varname), channel=varname)
+         continue
+      for gap in series_cache.missing(varname, t0, t1):
+         if archive_store is not None:
+            gaps = archive_store.missing(descr, gap[0], gap[1])
+         else:
+            gaps = [gap]
+         for ta, tb in gaps:
+            requests.setdefault(descr['host'], []).append((descr, ta, tb))
+   jobs = []
+   for host in requests:
+      nbatch = min(pool_size, len(requests[host]))
+      for n in range(0, nbatch):
+         batch = requests[host][n::nbatch]
+         jobs.append((batch, executor().submit(fetch_tables, host, batch)))
+   pieces = {}
+   for batch, job in jobs:
+      for request, series in zip(batch, job.result()):
+         pieces.setdefault(request[0]['name'], []).append(
+                           [request[1], request[2], series[0], series[1]])
+   results = {}
+   for varname in descrs:
+      descr = descrs[varname]
+      if not 'host' in descr:
+         results[varname] = [], []
+         continue
+      prefetched = pieces.get(varname, [])
+      values, times = series_cache.get(varname, t0, t1,
+                         lambda ta, tb: load_series(descr, ta, tb, prefetched))
+      results[varname] = filter_cond(values, times, cond)
+   return results
+
+def load_series(descr, t0, t1, prefetched=[]):
+   """
+   Load the series for [t0, t1] from the local archive store if one
+   is open, going to the archive servers for whatever it is missing,
+   or straight from the archive servers otherwise. Optional argument
+   prefetched is a list of segments [tlo, thi, values, times] already
+   read from the archive servers, which are used instead of a new
+   query wherever they cover the requested window.
+   """
+   def loader(ta, tb):
+      for seg in prefetched:
+         if seg[0] <= ta and tb <= seg[1]:
+            return slice_series(seg[2], seg[3], ta, tb)
+      return fetch_table(descr, ta, tb)
+   if archive_store is not None:
+      return archive_store.get(descr, t0, t1, loader)
+   return loader(t0, t1)
+
+def fetch_table(descr, t0, t1):
+   """
+   Query the archive table for the EPICS variable described in descr,
+   bypassing the cache, and return the values and times of the last
+   sample recorded before t0 and all samples recorded up to and
+   including t1.
+   """
    key = descr['name']
-   if key in epics_cache:
-      if t0 >= epics_cache[key][1][0] and t1 <= epics_cache[key][1][-1]:
-         i0 = bisect.bisect_left(epics_cache[key][1], t0)
-         i1 = bisect.bisect_right(epics_cache[key][1], t1)
-         values = [v for v in epics_cache[key][0][i0:i1]]
-         times = [t for t in epics_cache[key][1][i0:i1]]
-         if len(times) == 0 or times[0] > t0:
-            values.insert(0, epics_cache[key][0][i0-1])
-            times.insert(0, t0)
-         times[-1] = t1
-         return values, times
-   print("mya.fetch info: mya cache miss on", key)
+   host = descr['host']
+   archive = "history" if host == "hstmya1" else "ops"
+   report("fetch", "info", "mya cache miss on {0}".format(key), channel=key,
+          t0=t0, t1=t1)
    if archive != "ops":
-      print("mya.fetch warning: going back into {0} archive,".format(archive),
-               "this may take some time...")
+      report("fetch", "warning", "going back into {0} archive,"
+             " this may take some time...".format(archive), archive=archive)
    table = "table_{0}".format(descr['chan_id'])
-   cur = db[host].cursor()
-   cur.execute("select time from {0} where time < {1}".format(table, t0) +
-               " order by time desc limit 1")
-   row = cur.fetchone()
-   if not row:
-      print("mya.fetch warning: no entries found in archive for {0}"
-            "on or before {1}".format(descr['name'], time_epics_to_string(t0)))
-      return [], []
-   tini = row[0] - 1
-   tfin = row[0] + (dt * epics_second) + 1
-   cur.execute("select time,val1 from {0}".format(table) +
-               " where time > {0} and time < {1}".format(tini, tfin))
-   times = []
-   values = []
-   for row in cur.fetchall():
-      times.append(int(row[0]))
-      values.append(float(row[1]))
-   epics_cache[key] = values, times
-   print("mya.fetch info: {0} archive lookup returns {1} entries"
-         .format(archive, len(times)))
-   return filter_cond(values, times, cond)
+   heads, rows = execute(host, "select time from {0}".format(table) +
+                         " where time < {0}".format(t0) +
+                         " order by time desc limit 1")
+   if rows:
+      tini = rows[0][0] - 1
+   else:
+      report("fetch", "warning", "no entries found in archive for {0}"
+             " on or before {1}".format(key, time_epics_to_string(t0)),
+             channel=key, t0=t0)
+      tini = t0 - 1
+   tfin = t1 + 1
+   heads, rows = execute(host, "select time,val1 from {0}".format(table) +
+                         " where time > {0} and time < {1}".format(tini, tfin))
+   values, times = _rows_to_series(rows)
+   report("fetch", "info", "{0} archive lookup returns {1} entries"
+          .format(archive, len(times)), channel=key, rows=len(times))
+   return values, times
+
+# Maximum number of table windows combined into one union query
+# by fetch_tables().
+max_union = 64
+
+def fetch_tables(host, requests):
+   """
+   Read several windows of archive tables hosted on the same server,
+   bypassing the cache, combining them into union queries of up to
+   max_union windows each. Argument requests is a list of tuples
+   (descr, t0, t1), and the result is a list of matching values, times
+   pairs, each with the same content that fetch_table() would return.
+   """
+   results = []
+   for n0 in range(0, len(requests), max_union):
+      batch = requests[n0:n0 + max_union]
+      selects = []
+      for k in range(0, len(batch)):
+         table = "table_{0}".format(batch[k][0]['chan_id'])
+         selects.append("select * from (select {0} as k,time,val1"
+                        .format(k) +
+                        " from {0} where time < {1}".format(table, batch[k][1]) +
+                        " order by time desc limit 1) as p{0}".format(k))
+         selects.append("select * from (select {0} as k,time,val1"
+                        .format(k) +
+                        " from {0} where time >= {1}".format(table, batch[k][1]) +
+                        " and time <= {0}) as q{1}".format(batch[k][2], k))
+      heads, result = execute(host, " union all ".join(selects) +
+                              " order by k,time")
+      rows = [[] for request in batch]
+      for row in result:
+         rows[row[0]].append(row[1:])
+      for k in range(0, len(batch)):
+         results.append(_rows_to_series(rows[k]))
+   rows = sum(len(r[1]) for r in results)
+   report("fetch_tables", "info", "{0} archive lookup returns {1} entries"
+          " for {2} windows".format(host, rows, len(requests)),
+          host=host, rows=rows, windows=len(requests))
+   return results
 
-def plot(descr, t0, dt=0, cond=None):
+def fetch_since(host, requests):
+   """
+   Read the samples recorded after a given time in several archive
+   tables hosted on the same server, bypassing the cache, combining
+   them into union queries of up to max_union tables each. Argument
+   requests is a list of tuples (descr, tlast), and the result is a
+   list of matching values, times pairs holding every sample with
+   time > tlast.
+   """
+   results = []
+   for n0 in range(0, len(requests), max_union):
+      batch = requests[n0:n0 + max_union]
+      selects = []
+      for k in range(0, len(batch)):
+         table = "table_{0}".format(batch[k][0]['chan_id'])
+         selects.append("select * from (select {0} as k,time,val1"
+                        .format(k) +
+                        " from {0} where time > {1}".format(table, batch[k][1]) +
+                        ") as q{0}".format(k))
+      heads, result = execute(host, " union all ".join(selects) +
+                              " order by k,time")
+      rows = [[] for request in batch]
+      for row in result:
+         rows[row[0]].append(row[1:])
+      for k in range(0, len(batch)):
+         results.append(_rows_to_series(rows[k]))
+   return results
+
+class Tail:
+   """
+   Live subscription to a set of EPICS variables, which follows their
+   archive tables by polling only for rows newer than the last sample
+   seen on each channel, instead of fetching the whole window again.
+   New samples are appended to the cached series, so that fetch() over
+   a window ending at the time of the last poll is served from the
+   cache, and are handed to the caller as deltas, either by iterating
+   over follow() or by registering a callback with start().
+   """
+
+   def __init__(self, varnames, t0=None, interval=5):
+      """
+      Subscribe to the variables in varnames, whose history from time
+      t0 (default now) to now is loaded into the cache to begin with.
+      Argument interval is the polling period in seconds.
+      """
+      tnow = int(time.time() * epics_second)
+      if t0 is None:
+         t0 = tnow
+      elif isinstance(t0, str):
+         t0 = time_string_to_epics(t0)
+      self.interval = interval
+      self.last = {}
+      self.descrs = {}
+      self._stop = None
+      series = fetch_many(varnames, t0, (tnow - int(t0)) / epics_second)
+      descrs = lookup_many(varnames, "history" if t0 < opsmya_start
+                                     else "ops")
+      for varname in varnames:
+         if not 'host' in descrs[varname]:
+            continue
+         values, times = series[varname]
+         self.descrs[varname] = descrs[varname]
+         self.last[varname] = int(times[-1]) if len(times) > 0 else int(t0)
+         # the cache only records the window as complete up to its
+         # horizon, but the tail follows on from tnow
+         series_cache.append(varname, int(t0), tnow, values, times)
+
+   def poll(self):
+      """
+      Query the archive for samples newer than those already seen,
+      append them to the cache, and return a dict mapping the name of
+      each variable that has new samples to their values, times pair.
+      """
+      tnow = int(time.time() * epics_second)
+      requests = {}
+      for varname, descr in self.descrs.items():
+         requests.setdefault(descr['host'], []).append(
+                             (descr, self.last[varname]))
+      jobs = [(requests[host], executor().submit(fetch_since, host,
+                                                 requests[host]))
+              for host in requests]
+      deltas = {}
+      for batch, job in jobs:
+         for request, (values, times) in zip(batch, job.result()):
+            varname = request[0]['name']
+            series_cache.append(varname, self.last[varname], tnow,
+                                values, times)
+            if len(times) > 0:
+               self.last[varname] = int(times[-1])
+               deltas[varname] = values, times
+      return deltas
+
+   def follow(self):
+      """
+      Generator that polls every interval seconds and yields the dict
+      of new samples returned by poll() whenever it is not empty.
+      """
+      while True:
+         deltas = self.poll()
+         if deltas:
+            yield deltas
+         time.sleep(self.interval)
+
+   def start(self, callback):
+      """
+      Start a background thread that polls every interval seconds and
+      calls callback(deltas) with each non-empty result of poll(),
+      until stop() is called.
+      """
+      self.stop()
+      self._stop = threading.Event()
+      thread = threading.Thread(target=self._poll_loop,
+                                args=(self._stop, callback),
+                                name="mya tail")
+      thread.daemon = True
+      thread.start()
+
+   def stop(self):
+      """
+      Stop the background polling thread, if one is running.
+      """
+      if self._stop is not None:
+         self._stop.set()
+         self._stop = None
+
+   def _poll_loop(self, stop, callback):
+      while not stop.wait(self.interval):
+         try:
+            deltas = self.poll()
+         except Exception as e:
+            report("Tail", "warning", "poll failed, {0}".format(e))
+            continue
+         if deltas:
+            callback(deltas)
+
+def tail(varnames, t0=None, interval=5):
+   """
+   Return a Tail subscription to the EPICS variables in varnames,
+   which may also be a single variable name.
    """
-   Same as fetch, but return the results as a TGraph of values vs time.
+   if isinstance(varnames, str):
+      varnames = [varnames]
+   return Tail(varnames, t0, interval)
+
+def plot(descr, t0, dt=0, cond=None, npoints=4000):
+   """
+   Same as fetch, but draw the results as a graph of values vs time
+   with the plot backend, and return the graph, which for the default
+   root backend is a TGraph.
    A query condition may be provided as a logical expression in input
    variable cond, in which case only time periods that satisfy the
-   logical condition are included in the plot.
+   logical condition are included in the plot. The graph is reduced
+   to about npoints points with decimate(), which looks the same at
+   screen resolution; pass npoints=None to plot every sample.
    """
-   values, times = fetch(descr, t0, dt, cond)
+   values, times = fetch(descr, t0, dt, cond, npoints)
    if len(times) == 0:
-      print("mya.fetch warning: no data found for {0} during the requested"
-            "run period".format(descr))
+      report("fetch", "warning", "no data found for {0} during the requested"
+             "run period".format(descr), channel=descr)
       return 0
-   times = [(t - times[0]) / epics_second for t in times]
-   graph = ROOT.TGraph(len(times), array.array('d', times),
-                                   array.array('d', values))
+   if numpy is not None and isinstance(times, numpy.ndarray):
+      times = (times - times[0]) / epics_second
+      values = numpy.ascontiguousarray(values, dtype=numpy.float64)
+   else:
+      times = array.array('d', [(t - times[0]) / epics_second for t in times])
+      values = array.array('d', values)
    try:
-      graph.SetTitle(descr['name'])
+      title = descr['name']
    except:
-      graph.SetTitle(descr)
-   graph.GetXaxis().SetTitle("epoch time/s")
-   graph.Draw('AL')
-   c1 = ROOT.gROOT.FindObject("c1")
-   c1.Update()
-   return graph
+      title = descr
+   return backend('plot').plot(times, values, title)
 
 def filter_cond(values, times, cond):
    """
@@ -191,21 +912,1360 @@ def filter_cond(values, times, cond):
    """
    if not cond or len(times) == 0:
       return values, times
-   fvalues = []
-   ftimes = []
-   i = 0
-   for r in search_ranges(cond, times[0], times[-1]):
-      while i < len(times) and times[i] < r[0]:
-         i += 1
-      while i < len(times) and times[i] <= r[1]:
-         fvalues.append(values[i])
-         ftimes.append(times[i])
-         i += 1
-      if i == len(times):
+   ranges = [r for r in compile_query(cond).find(times[0], times[-1])]
+   starts = [r[0] for r in ranges]
+   ends = [r[1] for r in ranges]
+   return select_ranges(values, times, starts, ends)
+
+def select_ranges(values, times, starts, ends):
+   """
+   Return the samples of the time series values,times recorded inside
+   any of the time ranges starts[k] <= t <= ends[k], where starts and
+   ends are increasing and the ranges do not overlap. With numpy the
+   selection is made in one vectorized pass, by locating the range
+   boundaries with searchsorted and marking the samples between them
+   with a running sum; python list inputs are returned as lists.
+   """
+   if numpy is None:
+      fvalues = []
+      ftimes = []
+      i = 0
+      for k in range(0, len(starts)):
+         while i < len(times) and times[i] < starts[k]:
+            i += 1
+         while i < len(times) and times[i] <= ends[k]:
+            fvalues.append(values[i])
+            ftimes.append(times[i])
+            i += 1
+         if i == len(times):
+            break
+      return fvalues, ftimes
+   aslists = not isinstance(times, numpy.ndarray)
+   if aslists:
+      values = numpy.asarray(values, dtype=numpy.float64)
+      times = numpy.asarray(times, dtype=numpy.int64)
+   i0 = numpy.searchsorted(times, numpy.asarray(starts, dtype=numpy.int64),
+                           side='left')
+   i1 = numpy.searchsorted(times, numpy.asarray(ends, dtype=numpy.int64),
+                           side='right')
+   if len(i0) == 1:
+      values, times = values[i0[0]:i1[0]], times[i0[0]:i1[0]]
+   else:
+      edges = numpy.zeros(len(times) + 1, dtype=numpy.int64)
+      numpy.add.at(edges, i0, 1)
+      numpy.add.at(edges, i1, -1)
+      mask = numpy.cumsum(edges[:-1]) > 0
+      values, times = values[mask], times[mask]
+   if aslists:
+      return values.tolist(), times.tolist()
+   return values, times
+
+def _normalize_ranges(ranges):
+   """
+   Sort a list of ranges (tstart, tend, ...) and merge those that
+   overlap or touch, dropping empty ones. Returns a list of
+   [tstart, tend] pairs.
+   """
+   merged = []
+   for r in sorted((r[0], r[1]) for r in ranges if r[1] > r[0]):
+      if merged and r[0] <= merged[-1][1]:
+         merged[-1][1] = max(merged[-1][1], r[1])
+      else:
+         merged.append([r[0], r[1]])
+   return merged
+
+def range_union(*range_lists):
+   """
+   Return the union of any number of lists of time ranges, each a
+   sequence of tuples (tstart, tend, ...) as yielded by find_ranges(),
+   as a sorted list of disjoint ranges (tstart, tend, True).
+   """
+   ranges = [r for range_list in range_lists for r in range_list]
+   return [(r[0], r[1], True) for r in _normalize_ranges(ranges)]
+
+def range_intersection(*range_lists):
+   """
+   Return the intersection of any number of lists of time ranges,
+   each a sequence of tuples (tstart, tend, ...) as yielded by
+   find_ranges(), as a sorted list of disjoint ranges
+   (tstart, tend, True).
+   """
+   if len(range_lists) == 0:
+      return []
+   result = _normalize_ranges(range_lists[0])
+   for range_list in range_lists[1:]:
+      other = _normalize_ranges(range_list)
+      overlap = []
+      i = j = 0
+      while i < len(result) and j < len(other):
+         tstart = max(result[i][0], other[j][0])
+         tend = min(result[i][1], other[j][1])
+         if tend > tstart:
+            overlap.append([tstart, tend])
+         if result[i][1] < other[j][1]:
+            i += 1
+         else:
+            j += 1
+      result = overlap
+   return [(r[0], r[1], True) for r in result]
+
+def range_complement(ranges, t0, t1):
+   """
+   Return the parts of the interval [t0, t1] not covered by the list
+   of time ranges, a sequence of tuples (tstart, tend, ...) as yielded
+   by find_ranges(), as a sorted list of disjoint ranges
+   (tstart, tend, True).
+   """
+   result = []
+   tnext = t0
+   for r in _normalize_ranges(ranges):
+      if r[1] <= t0:
+         continue
+      elif r[0] >= t1:
          break
-   return fvalues, ftimes
+      if r[0] > tnext:
+         result.append((tnext, r[0], True))
+      tnext = max(tnext, r[1])
+   if tnext < t1:
+      result.append((tnext, t1, True))
+   return result
+
+def slice_series(values, times, t0, t1):
+   """
+   Return the part of the time series values,times that covers the
+   interval [t0, t1], starting with the last sample recorded on or
+   before t0 and ending with the last sample recorded on or before t1.
+   For numpy arrays the result is a pair of views into the inputs.
+   """
+   if numpy is not None and isinstance(times, numpy.ndarray):
+      i0 = max(int(numpy.searchsorted(times, t0, side='right')) - 1, 0)
+      i1 = int(numpy.searchsorted(times, t1, side='right'))
+   else:
+      i0 = max(bisect.bisect_right(times, t0) - 1, 0)
+      i1 = bisect.bisect_right(times, t1)
+   return values[i0:i1], times[i0:i1]
+
+def _rows_to_series(rows):
+   """
+   Convert a sequence of (time, value) rows into a values, times pair
+   of python lists, or numpy arrays if use_arrays is set.
+   """
+   if use_arrays:
+      times = numpy.fromiter((row[0] for row in rows),
+                             dtype=numpy.int64, count=len(rows))
+      values = numpy.fromiter((row[1] for row in rows),
+                              dtype=numpy.float64, count=len(rows))
+   else:
+      times = [int(row[0]) for row in rows]
+      values = [float(row[1]) for row in rows]
+   return values, times
+
+def _series_nbytes(values, times):
+   """
+   Estimate the memory footprint of a time series in bytes.
+   """
+   if numpy is not None and isinstance(times, numpy.ndarray):
+      return values.nbytes + times.nbytes
+   return sys.getsizeof(values) + sys.getsizeof(times) + len(times) * 60
+
+def _concat_series(pieces):
+   """
+   Join a list of contiguous or overlapping cache segments
+   [tlo, thi, values, times], sorted by tlo, into a single values,
+   times pair. Each segment contributes its samples up to its thi
+   that are later than the end of the segments before it.
+   """
+   vlist = []
+   tlist = []
+   tcovered = None
+   for tlo, thi, values, times in pieces:
+      if numpy is not None and isinstance(times, numpy.ndarray):
+         i1 = int(numpy.searchsorted(times, thi, side='right'))
+         i0 = (0 if tcovered is None else
+               int(numpy.searchsorted(times, tcovered, side='right')))
+      else:
+         i1 = bisect.bisect_right(times, thi)
+         i0 = 0 if tcovered is None else bisect.bisect_right(times, tcovered)
+      if i1 > i0 or len(tlist) == 0:
+         vlist.append(values[i0:i1])
+         tlist.append(times[i0:i1])
+      tcovered = thi if tcovered is None else max(tcovered, thi)
+   if numpy is not None and isinstance(tlist[0], numpy.ndarray):
+      return numpy.concatenate(vlist), numpy.concatenate(tlist)
+   values = []
+   times = []
+   for k in range(0, len(tlist)):
+      values.extend(vlist[k])
+      times.extend(tlist[k])
+   return values, times
 
-def search_ranges(query, t0, t1):
+def _find_gaps(segments, t0, t1):
+   """
+   Given a time-ordered list of segments that each begin with their
+   (tlo, thi) window, return the list of (ta, tb) windows in [t0, t1]
+   that none of them cover.
+   """
+   gaps = []
+   tnext = t0
+   for seg in segments:
+      if seg[0] > tnext:
+         gaps.append((tnext, seg[0]))
+      tnext = max(tnext, seg[1])
+   if tnext < t1 or len(segments) == 0:
+      gaps.append((tnext, t1))
+   return gaps
+
+# Layout of the binary columnar payload written by encode_series(),
+# all numbers little-endian: a header of
+#    magic b"MYA1", flags uint8 (bit 0 set if the body is zlib
+#    compressed), value size uint8 (4 = float32, 8 = float64),
+#    channel count uint16
+# followed by the body, holding for each channel
+#    name length uint16, name (utf-8), sample count uint32,
+#    first time int64, count-1 time deltas int64, count values
+_payload_magic = b"MYA1"
+_payload_header = struct.Struct("<4sBBH")
+_channel_header = struct.Struct("<HI")
+
+def encode_series(series, value_type="float64", compress=False):
+   """
+   Pack a dict mapping channel names to values, times pairs, such as
+   fetch_many() returns, into a compact binary columnar payload: the
+   times are delta-encoded as int64 and the values stored as float64,
+   or float32 if value_type is "float32", optionally compressed with
+   zlib. See decode_series() for the inverse.
+   """
+   vsize = {"float64": 8, "float32": 4}.get(value_type)
+   if vsize is None:
+      raise ValueError("mya.encode_series error: unknown value type {0}"
+                       .format(value_type))
+   body = []
+   for name, (values, times) in series.items():
+      encoded = name.encode("utf-8")
+      body.append(_channel_header.pack(len(encoded), len(times)))
+      body.append(encoded)
+      if len(times) == 0:
+         continue
+      if numpy is not None:
+         times = numpy.asarray(times, dtype=numpy.int64)
+         deltas = numpy.concatenate((times[:1], numpy.diff(times)))
+         body.append(deltas.astype("<i8").tobytes())
+         body.append(numpy.asarray(values).astype("<f{0}".format(vsize))
+                     .tobytes())
+      else:
+         deltas = array.array('q', [times[0]] +
+                              [times[i] - times[i-1]
+                               for i in range(1, len(times))])
+         floats = array.array('d' if vsize == 8 else 'f', values)
+         if sys.byteorder == "big":
+            deltas.byteswap()
+            floats.byteswap()
+         body.append(deltas.tobytes())
+         body.append(floats.tobytes())
+   body = b"".join(body)
+   if compress:
+      body = zlib.compress(body)
+   return _payload_header.pack(_payload_magic, int(bool(compress)), vsize,
+                               len(series)) + body
+
+def decode_series(payload):
+   """
+   Unpack a payload written by encode_series() into a dict mapping
+   channel names to values, times pairs, as numpy arrays if numpy is
+   available and python lists otherwise.
+   """
+   magic, flags, vsize, nchan = _payload_header.unpack_from(payload, 0)
+   if magic != _payload_magic:
+      raise ValueError("mya.decode_series error: not a mya payload")
+   body = payload[_payload_header.size:]
+   if flags & 1:
+      body = zlib.decompress(body)
+   body = memoryview(body)
+   series = {}
+   pos = 0
+   for n in range(0, nchan):
+      namelen, count = _channel_header.unpack_from(body, pos)
+      pos += _channel_header.size
+      name = bytes(body[pos:pos + namelen]).decode("utf-8")
+      pos += namelen
+      tbytes = body[pos:pos + 8 * count]
+      pos += 8 * count
+      vbytes = body[pos:pos + vsize * count]
+      pos += vsize * count
+      if numpy is not None:
+         times = numpy.cumsum(numpy.frombuffer(tbytes, dtype="<i8"),
+                              dtype=numpy.int64)
+         values = numpy.frombuffer(vbytes, dtype="<f{0}".format(vsize))
+         series[name] = values.astype(numpy.float64), times
+      else:
+         deltas = array.array('q', bytes(tbytes))
+         floats = array.array('d' if vsize == 8 else 'f', bytes(vbytes))
+         if sys.byteorder == "big":
+            deltas.byteswap()
+            floats.byteswap()
+         series[name] = (list(floats),
+                         list(itertools.accumulate(deltas)))
+   return series
+
+class SeriesCache:
+   """
+   Memory-bounded cache of archived time series, used by fetch().
+   Each channel holds a sorted list of disjoint segments
+      [tlo, thi, values, times]
+   where the series contains the last sample recorded on or before tlo
+   followed by every sample recorded up to and including thi. Requests
+   that overlap cached segments only fetch the missing pieces, which
+   are spliced together with the neighboring segments into one. Only
+   data older than horizon seconds are recorded as complete, since
+   samples may still be arriving at the archive for the most recent
+   times, so that a window reaching up to now or into the future is
+   queried again for its recent end on the next request. When the
+   total size exceeds max_bytes, whole channels are evicted in
+   least-recently-used order. The cache is shared between threads,
+   with a lock held while segments are looked up or changed, but not
+   while get() calls its loader, so that a slow archive query does not
+   hold up other threads or a Tail polling thread appending samples.
+   """
+
+   def __init__(self, max_bytes=1 << 30, horizon=60):
+      self.max_bytes = max_bytes
+      self.horizon = horizon
+      self.nbytes = 0
+      self.channels = collections.OrderedDict()
+      self.lock = threading.RLock()
+
+   def __contains__(self, key):
+      with self.lock:
+         return key in self.channels
+
+   def clear(self):
+      with self.lock:
+         self.channels.clear()
+         self.nbytes = 0
+
+   def discard(self, key):
+      """
+      Drop all cached segments for channel key.
+      """
+      with self.lock:
+         for seg in self.channels.pop(key, []):
+            self.nbytes -= _series_nbytes(seg[2], seg[3])
+
+   def segments(self, key):
+      """
+      Return the list of (tlo, thi) time windows cached for channel key.
+      """
+      with self.lock:
+         return [(seg[0], seg[1]) for seg in self.channels.get(key, [])]
+
+   def get(self, key, t0, t1, loader):
+      """
+      Return the values, times series for channel key covering the
+      interval [t0, t1], as described for slice_series(). Any parts of
+      the interval not yet in the cache are obtained by calling
+      loader(ta, tb), which must return the series for [ta, tb].
+      """
+      tstable = int((time.time() - self.horizon) * epics_second)
+      with self.lock:
+         segments = self.channels.setdefault(key, [])
+         self.channels.move_to_end(key)
+         overlap = [list(seg) for seg in segments
+                    if seg[1] >= t0 and seg[0] <= t1]
+         gaps = _find_gaps(overlap, t0, t1)
+         if len(gaps) == 0 and len(overlap) == 1:
+            metrics.record_cache('hit')
+            return slice_series(overlap[0][2], overlap[0][3], t0, t1)
+         metrics.record_cache('partial' if len(overlap) > 0 and
+                              sum(gap[1] - gap[0] for gap in gaps) < t1 - t0
+                              else 'miss')
+      pieces = list(overlap)
+      for gap in gaps:
+         values, times = loader(gap[0], gap[1])
+         pieces.append([gap[0], gap[1], values, times])
+      pieces.sort(key=lambda seg: seg[0])
+      values, times = _concat_series(pieces)
+      tlo = pieces[0][0]
+      thi = max([min(t1, tstable)] + [seg[1] for seg in overlap])
+      if thi >= tlo:
+         self._insert(key, [tlo, thi] + list(slice_series(values, times,
+                                                          tlo, thi)))
+      return slice_series(values, times, t0, t1)
+
+   def _insert(self, key, merged):
+      # Splice segment merged into the cache for channel key, joining
+      # it with any segments that overlap it, which may have changed
+      # since get() looked while its loader was running.
+      with self.lock:
+         segments = self.channels.setdefault(key, [])
+         first = 0
+         while first < len(segments) and segments[first][1] < merged[0]:
+            first += 1
+         last = first
+         while last < len(segments) and segments[last][0] <= merged[1]:
+            last += 1
+         overlap = segments[first:last]
+         if len(overlap) > 0:
+            pieces = sorted(overlap + [merged], key=lambda seg: seg[0])
+            merged = [pieces[0][0], max(seg[1] for seg in pieces)]
+            merged += list(_concat_series(pieces))
+         for seg in overlap:
+            self.nbytes -= _series_nbytes(seg[2], seg[3])
+         self.nbytes += _series_nbytes(merged[2], merged[3])
+         segments[first:last] = [merged]
+         self.evict()
+
+   def missing(self, key, t0, t1):
+      """
+      Return the list of (ta, tb) windows inside [t0, t1] that are not
+      cached for channel key.
+      """
+      with self.lock:
+         segments = [seg for seg in self.channels.get(key, [])
+                     if seg[1] >= t0 and seg[0] <= t1]
+         return _find_gaps(segments, t0, t1)
+
+   def store(self, key, t0, t1, values, times):
+      """
+      Insert the series values, times covering [t0, t1] for channel
+      key, keeping any data already cached in that window.
+      """
+      self.get(key, t0, t1, lambda ta, tb: slice_series(values, times,
+                                                        ta, tb))
+
+   def append(self, key, tlast, t1, values, times):
+      """
+      Extend the latest cached segment of channel key with the samples
+      in values, times that are newer than its last sample, and mark it
+      complete up to time t1. This is how Tail adds live data, where
+      values, times are all the samples recorded after time tlast, so
+      nothing is done unless the latest segment is complete up to tlast,
+      as the samples would not be contiguous with it otherwise. If it
+      is not, but the series also starts with the sample in effect at
+      tlast, it is added as a new segment [tlast, t1] instead.
+      """
+      with self.lock:
+         segments = self.channels.setdefault(key, [])
+         if len(segments) == 0 or segments[-1][1] < tlast:
+            if len(times) > 0 and times[0] <= tlast:
+               if not (numpy is not None and
+                       isinstance(times, numpy.ndarray)):
+                  values, times = list(values), list(times)
+               segments.append([tlast, t1, values, times])
+               self.nbytes += _series_nbytes(values, times)
+               self.evict()
+            return
+         seg = segments[-1]
+         if len(seg[3]) > 0:
+            if numpy is not None and isinstance(times, numpy.ndarray):
+               i0 = int(numpy.searchsorted(times, seg[3][-1], side='right'))
+            else:
+               i0 = bisect.bisect_right(times, seg[3][-1])
+            values, times = values[i0:], times[i0:]
+         self.nbytes -= _series_nbytes(seg[2], seg[3])
+         if numpy is not None and isinstance(seg[3], numpy.ndarray):
+            seg[2] = numpy.concatenate([seg[2], values])
+            seg[3] = numpy.concatenate([seg[3], times])
+         else:
+            seg[2].extend(values)
+            seg[3].extend(times)
+         seg[1] = max(seg[1], t1)
+         self.nbytes += _series_nbytes(seg[2], seg[3])
+         self.evict()
+
+   def evict(self):
+      """
+      Discard least-recently-used channels until the cache fits within
+      max_bytes, always keeping the most recently used channel.
+      """
+      with self.lock:
+         while self.nbytes > self.max_bytes and len(self.channels) > 1:
+            key = next(iter(self.channels))
+            self.discard(key)
+
+class ArchiveStore:
+   """
+   Persistent local copy of archived time series, kept in a directory
+   of SQLite files, one per channel named <host>_<chan_id>.sqlite, and
+   a descriptors.sqlite holding the lookup() results. Each channel file
+   has a samples table of (time, val) rows and a segments table of
+   (tlo, thi) windows that are known to be complete, with the same
+   meaning as in SeriesCache. Only data older than horizon seconds
+   are stored, since the archive may still change after that. When
+   the channel files exceed max_bytes in total, the least recently
+   used ones are deleted. The total is kept as a running size, which
+   is only checked against the directory when it exceeds max_bytes,
+   since other processes may share the store.
+
+   Each channel file also holds a rollup_<width> table for each of
+   the bin widths in rollup_widths, with one row per bin
+      (tbin, count, min, max, integral, duration, last)
+   summarizing the samples in [tbin, tbin + width) as for bin_series(),
+   with integral the time integral of the value in value*s. The bins
+   are aligned to multiples of their width, and are added as soon as
+   the stored segments cover them completely, see fetch_rollup().
+   """
+
+   def __init__(self, path, max_bytes=10 << 30, horizon=6 * 3600):
+      self.path = path
+      self.max_bytes = max_bytes
+      self.horizon = horizon
+      os.makedirs(path, exist_ok=True)
+      self.size = self.nbytes()
+      with self._connect("descriptors.sqlite") as con:
+         con.execute("create table if not exists descriptors"
+                     " (deployment text, name text, descr text,"
+                     " primary key (deployment, name))")
+
+   def _connect(self, filename):
+      return sqlite3.connect(os.path.join(self.path, filename))
+
+   def _filename(self, descr):
+      return "{0}_{1}.sqlite".format(descr['host'], descr['chan_id'])
+
+   def _open(self, descr):
+      con = self._connect(self._filename(descr))
+      con.execute("create table if not exists samples"
+                  " (time integer primary key, val real)")
+      con.execute("create table if not exists segments"
+                  " (tlo integer, thi integer)")
+      for width in rollup_widths:
+         con.execute("create table if not exists rollup_{0}".format(width) +
+                     " (tbin integer primary key, count integer,"
+                     " min real, max real, integral real, duration real,"
+                     " last real)")
+      return con
+
+   def lookup(self, varname, deployment="ops"):
+      """
+      Return the stored descriptor for varname, or {} if none.
+      """
+      with self._connect("descriptors.sqlite") as con:
+         row = con.execute("select descr from descriptors"
+                           " where deployment = ? and name = ?",
+                           (deployment, varname)).fetchone()
+      if row:
+         return json.loads(row[0])
+      return {}
+
+   def save_descriptor(self, varname, deployment, descr):
+      with self._connect("descriptors.sqlite") as con:
+         con.execute("insert or replace into descriptors values (?, ?, ?)",
+                     (deployment, varname, json.dumps(descr, default=str)))
+
+   def missing(self, descr, t0, t1):
+      """
+      Return the list of (ta, tb) windows inside [t0, t1] that are not
+      stored for the channel described by descr.
+      """
+      con = self._open(descr)
+      try:
+         segments = con.execute("select tlo, thi from segments"
+                                " where thi >= ? and tlo <= ?"
+                                " order by tlo", (t0, t1)).fetchall()
+      finally:
+         con.close()
+      return _find_gaps(segments, t0, t1)
+
+   def get(self, descr, t0, t1, loader):
+      """
+      Return the values, times series for the channel described by
+      descr covering [t0, t1], reading from the local files what they
+      hold and calling loader(ta, tb) for the rest. Whatever loader
+      returns that is older than the horizon is added to the files.
+      """
+      tstable = int((time.time() - self.horizon) * epics_second)
+      filename = os.path.join(self.path, self._filename(descr))
+      size = os.path.getsize(filename) if os.path.exists(filename) else 0
+      con = self._open(descr)
+      try:
+         segments = con.execute("select tlo, thi from segments"
+                                " where thi >= ? and tlo <= ?"
+                                " order by tlo", (t0, t1)).fetchall()
+         pieces = []
+         tnext = t0
+         for seg in segments:
+            if seg[0] > tnext:
+               pieces.append(self._load(con, descr, tnext, seg[0],
+                                        tstable, loader))
+            tlo = max(tnext, seg[0])
+            thi = min(t1, seg[1])
+            if thi >= tlo:
+               pieces.append([tlo, thi] + list(self._read(con, tlo, thi)))
+            tnext = max(tnext, seg[1])
+         if tnext < t1 or len(pieces) == 0:
+            pieces.append(self._load(con, descr, tnext, t1, tstable, loader))
+         con.commit()
+      finally:
+         con.close()
+      os.utime(filename)
+      self.size += os.path.getsize(filename) - size
+      if self.size > self.max_bytes:
+         self.evict()
+      if len(pieces) == 1:
+         return pieces[0][2], pieces[0][3]
+      return _concat_series(pieces)
+
+   def _read(self, con, t0, t1):
+      rows = con.execute("select time, val from samples where time <= ?"
+                         " order by time desc limit 1", (t0,)).fetchall()
+      rows += con.execute("select time, val from samples"
+                          " where time > ? and time <= ? order by time",
+                          (t0, t1)).fetchall()
+      return _rows_to_series(rows)
+
+   def _load(self, con, descr, t0, t1, tstable, loader):
+      values, times = loader(t0, t1)
+      tend = min(t1, tstable)
+      if tend >= t0:
+         n = bisect.bisect_right(times, tend)
+         con.executemany("insert or ignore into samples values (?, ?)",
+                         zip([int(t) for t in times[:n]],
+                             [float(v) for v in values[:n]]))
+         merged = con.execute("select min(tlo), max(thi) from segments"
+                              " where thi >= ? and tlo <= ?",
+                              (t0, tend)).fetchone()
+         tlo = t0 if merged[0] is None else min(t0, merged[0])
+         thi = tend if merged[1] is None else max(tend, merged[1])
+         con.execute("delete from segments where thi >= ? and tlo <= ?",
+                     (t0, tend))
+         con.execute("insert into segments values (?, ?)", (tlo, thi))
+         self._update_rollups(con, tlo, thi, t0, tend)
+      return [t0, t1, values, times]
+
+   def _update_rollups(self, con, tlo, thi, ta, tb):
+      # Fill in the rollup bins that lie inside the stored segment
+      # [tlo, thi] and overlap the newly stored window [ta, tb].
+      for width in rollup_widths:
+         w = width * epics_second
+         k0 = max(-(-tlo // w), ta // w)
+         k1 = min(thi // w, -(-tb // w))
+         if k1 <= k0:
+            continue
+         values, times = self._read(con, k0 * w, k1 * w)
+         bins = bin_series(values, times, k0 * w, k1 * w, k1 - k0)
+         rows = []
+         for k in range(0, k1 - k0):
+            mean = float(bins['mean'][k])
+            duration = float(bins['duration'][k])
+            rows.append((int(bins['time'][k]), int(bins['count'][k]),
+                         float(bins['min'][k]), float(bins['max'][k]),
+                         mean * duration if duration > 0 else 0.,
+                         duration, float(bins['last'][k])))
+         con.executemany("insert or replace into rollup_{0}".format(width) +
+                         " values (?, ?, ?, ?, ?, ?, ?)", rows)
+
+   def build_rollups(self, descr):
+      """
+      Compute the rollup bins for all stored segments of the channel
+      described by descr, for files written before the rollup tables
+      existed or after rollup_widths was changed.
+      """
+      con = self._open(descr)
+      try:
+         for tlo, thi in con.execute("select tlo, thi from segments"
+                                     ).fetchall():
+            self._update_rollups(con, tlo, thi, tlo, thi)
+         con.commit()
+      finally:
+         con.close()
+
+   def rollup(self, descr, t0, t1, width):
+      """
+      Return a dict mapping bin start time to the stored rollup row
+      (count, min, max, integral, duration, last) for the bins of the
+      given width that start in [t0, t1) for the channel described by
+      descr. Bins that are not stored are absent.
+      """
+      con = self._open(descr)
+      try:
+         rows = con.execute("select * from rollup_{0}".format(width) +
+                            " where tbin >= ? and tbin < ?",
+                            (t0, t1)).fetchall()
+      finally:
+         con.close()
+      return {row[0]: row[1:] for row in rows}
+
+   def nbytes(self):
+      """
+      Return the total size in bytes of the channel files.
+      """
+      total = 0
+      for entry in os.scandir(self.path):
+         if entry.name != "descriptors.sqlite":
+            total += entry.stat().st_size
+      return total
+
+   def evict(self):
+      """
+      Delete least recently modified channel files until the store
+      fits within max_bytes.
+      """
+      files = [entry for entry in os.scandir(self.path)
+               if entry.name.endswith(".sqlite")
+               and entry.name != "descriptors.sqlite"]
+      total = sum(entry.stat().st_size for entry in files)
+      files.sort(key=lambda entry: entry.stat().st_mtime)
+      while total > self.max_bytes and len(files) > 1:
+         entry = files.pop(0)
+         total -= entry.stat().st_size
+         os.remove(entry.path)
+      self.size = total
+
+# Widths in seconds of the rollup bins kept by ArchiveStore.
+rollup_widths = (60, 3600, 86400)
+
+series_cache = SeriesCache()
+archive_store = None
+
+def open_store(path, max_bytes=10 << 30, horizon=6 * 3600):
+   """
+   Enable the persistent local archive store in directory path, which
+   is created if it does not exist. Subsequent calls to lookup() and
+   fetch() consult the store before going to the archive servers. See
+   ArchiveStore for the meaning of the other arguments.
+   """
+   global archive_store
+   archive_store = ArchiveStore(path, max_bytes, horizon)
+   return archive_store
+
+def close_store():
+   """
+   Disable the persistent local archive store.
+   """
+   global archive_store
+   archive_store = None
+
+class ChannelDirectory:
+   """
+   In-memory index of the archive directory for one deployment, built
+   from the channels, groups and members tables, so that lookup(),
+   name searches and group views need no round trips to the server.
+   The index can also be built offline from a tab-separated snapshot
+   of those tables such as groups.list, as written by the mysql client.
+   """
+
+   def __init__(self, deployment="ops"):
+      self.deployment = deployment
+      self.lock = threading.Lock()
+      self.channels = {}
+      self.by_id = {}
+      self.names = []
+      self.groups = {}
+      self.members = {}
+      self.tables = None
+      self.last_chan_id = -1
+      self.loaded = None
+      self._stop = None
+
+   def host(self):
+      if self.deployment == "ops":
+         return "opsmya0"
+      elif self.deployment == "history":
+         return "hstmya1"
+      raise ValueError("mya.ChannelDirectory error: unknown archive"
+                       " deployment {0}".format(self.deployment))
+
+   def load(self):
+      """
+      Read the full channels, groups and members tables from the
+      archive server and replace the contents of the index.
+      """
+      host = self.host()
+      channels = _rows_to_dicts(*execute(host, "select * from channels"))
+      groups = _rows_to_dicts(*execute(host, "select * from `groups`"))
+      members = _rows_to_dicts(*execute(host, "select * from members"))
+      self._install(channels, groups, members, replace=True)
+
+   def refresh(self):
+      """
+      Bring the index up to date with the archive server, fetching
+      only the channels added since the last load or refresh together
+      with the (small) groups and members tables.
+      """
+      host = self.host()
+      channels = _rows_to_dicts(*execute(host, "select * from channels"
+                                         " where chan_id > %s",
+                                         (self.last_chan_id,)))
+      groups = _rows_to_dicts(*execute(host, "select * from `groups`"))
+      members = _rows_to_dicts(*execute(host, "select * from members"))
+      self._install(channels, groups, members, replace=False)
+
+   def load_snapshot(self, channels=None, groups=None, members=None,
+                           tables=None):
+      """
+      Load the index from snapshot files of the directory tables, any
+      of which may be omitted. Each is a tab-separated listing with
+      a header row naming the columns, as written by the mysql client
+      for "select * from <table>". The optional tables file is the
+      output of "show tables", and restricts the index to channels
+      whose table_<chan_id> exists on the server.
+      """
+      if tables is not None:
+         with open(tables) as fin:
+            self.tables = set(int(line[6:]) for line in fin
+                              if line.startswith("table_"))
+      self._install(_read_snapshot(channels) if channels else [],
+                    _read_snapshot(groups) if groups else [],
+                    _read_snapshot(members) if members else [],
+                    replace=True)
+
+   def _install(self, channels, groups, members, replace):
+      if self.tables is not None:
+         channels = [row for row in channels
+                     if row.get('chan_id') in self.tables]
+      with self.lock:
+         index = {} if replace else dict(self.channels)
+         for row in channels:
+            index[row['name']] = row
+         self.channels = index
+         self.by_id = {row['chan_id']: row for row in index.values()}
+         self.names = sorted(index)
+         self.groups = {row['group_id']: row for row in groups}
+         membership = {}
+         for row in members:
+            membership.setdefault(row['group_id'], []).append(row['chan_id'])
+         self.members = membership
+         if channels:
+            self.last_chan_id = max(self.last_chan_id,
+                                    max(row['chan_id'] for row in channels))
+         self.loaded = time.time()
+
+   def lookup(self, varname):
+      """
+      Return the descriptor of channel varname, or None if it is not
+      in the index.
+      """
+      return self.channels.get(varname)
+
+   def search(self, pattern, mode="prefix", limit=None):
+      """
+      Return the sorted list of channel names matching pattern, which
+      is interpreted according to mode as a name prefix ("prefix"),
+      a shell wildcard pattern ("glob") or a regular expression that
+      must match at the start of the name ("regex"). At most limit
+      names are returned if limit is given.
+      """
+      names = self.names
+      if mode == "prefix":
+         prefix = pattern
+         match = None
+      elif mode == "glob":
+         prefix = re.split(r"[*?\[]", pattern, 1)[0]
+         match = re.compile(fnmatch.translate(pattern)).match
+      elif mode == "regex":
+         prefix = ""
+         match = re.compile(pattern).match
+      else:
+         raise ValueError("mya.ChannelDirectory error: unknown search"
+                          " mode {0}".format(mode))
+      found = []
+      for i in range(bisect.bisect_left(names, prefix), len(names)):
+         name = names[i]
+         if not name.startswith(prefix):
+            break
+         if match is None or match(name):
+            found.append(name)
+            if limit is not None and len(found) >= limit:
+               break
+      return found
+
+   def find_groups(self, name):
+      """
+      Return the ids of all groups with the given name.
+      """
+      return [gid for gid, row in self.groups.items() if row['name'] == name]
+
+   def group_channels(self, group, recursive=True):
+      """
+      Return the sorted list of names of the channels in group, given
+      by group_id or by name. With recursive, the channels of all
+      groups nested below it, by way of their parent_id, are included.
+      """
+      groups = self.groups
+      if group in groups:
+         todo = [group]
+      else:
+         todo = self.find_groups(group)
+      if recursive:
+         children = {}
+         for gid, row in groups.items():
+            if row.get('parent_id') != gid:
+               children.setdefault(row.get('parent_id'), []).append(gid)
+      seen = set()
+      chan_ids = set()
+      while todo:
+         gid = todo.pop()
+         if gid in seen:
+            continue
+         seen.add(gid)
+         chan_ids.update(self.members.get(gid, ()))
+         if recursive:
+            todo.extend(children.get(gid, ()))
+      by_id = self.by_id
+      return sorted(by_id[chan_id]['name'] for chan_id in chan_ids
+                    if chan_id in by_id)
+
+   def start_refresh(self, interval=600):
+      """
+      Start a background thread that calls refresh() every interval
+      seconds until stop_refresh() is called.
+      """
+      self.stop_refresh()
+      self._stop = threading.Event()
+      thread = threading.Thread(target=self._refresh_loop,
+                                args=(self._stop, interval),
+                                name="mya directory refresh")
+      thread.daemon = True
+      thread.start()
+
+   def stop_refresh(self):
+      """
+      Stop the background refresh thread, if one is running.
+      """
+      if self._stop is not None:
+         self._stop.set()
+         self._stop = None
+
+   def _refresh_loop(self, stop, interval):
+      while not stop.wait(interval):
+         try:
+            self.refresh()
+         except Exception as e:
+            report("ChannelDirectory", "warning",
+                   "refresh failed, {0}".format(e))
+
+def _rows_to_dicts(heads, rows):
+   names = [head[0] for head in heads]
+   return [dict(zip(names, row)) for row in rows]
+
+def _read_snapshot(path):
+   rows = []
+   with open(path) as fin:
+      heads = fin.readline().rstrip("\n").split("\t")
+      for line in fin:
+         fields = line.rstrip("\n").split("\t")
+         row = {}
+         for head, field in zip(heads, fields):
+            if field == "NULL":
+               row[head] = None
+            elif re.match(r"-?[0-9]+$", field):
+               row[head] = int(field)
+            else:
+               try:
+                  row[head] = float(field)
+               except ValueError:
+                  row[head] = field
+         rows.append(row)
+   return rows
+
+directory = None
+
+def open_directory(deployment="ops", refresh=600, snapshot=None):
+   """
+   Build the channel directory index for deployment and make lookup()
+   and lookup_many() answer from it. The index is loaded from the
+   archive server, or from snapshot if given, which is a dict of
+   keyword arguments for ChannelDirectory.load_snapshot. Unless
+   refresh is None, the index is refreshed from the server every
+   refresh seconds in the background.
+   """
+   global directory
+   close_directory()
+   index = ChannelDirectory(deployment)
+   if snapshot is not None:
+      index.load_snapshot(**snapshot)
+   else:
+      index.load()
+   if refresh is not None:
+      index.start_refresh(refresh)
+   directory = index
+   return index
+
+def close_directory():
+   """
+   Stop using the channel directory index.
+   """
+   global directory
+   if directory is not None:
+      directory.stop_refresh()
+   directory = None
+
+def decimate(values, times, npoints, t0=None, t1=None):
+   """
+   Reduce the time series values,times to at most npoints samples by
+   dividing [t0, t1] (default: the span of times) into npoints/4 equal
+   bins and keeping only the first, last, minimum and maximum samples
+   of each bin. The result is a subset of the input samples, so step
+   changes stay at their recorded times, and a line drawn through it
+   at the bin resolution looks the same as one through the full series.
+   """
+   if len(times) <= npoints:
+      return values, times
+   if t0 is None:
+      t0 = times[0]
+   if t1 is None:
+      t1 = times[-1]
+   nbins = max(npoints // 4, 1)
+   width = max(t1 - t0, 1) / nbins
+   if numpy is not None and isinstance(times, numpy.ndarray):
+      bins = numpy.clip((times - t0) // width, 0, nbins - 1)
+      starts = numpy.flatnonzero(numpy.diff(bins)) + 1
+      starts = numpy.concatenate(([0], starts))
+      ends = numpy.concatenate((starts[1:], [len(times)])) - 1
+      order = numpy.lexsort((values, bins))
+      keep = numpy.unique(numpy.concatenate((starts, ends,
+                                             order[starts], order[ends])))
+      return values[keep], times[keep]
+   binof = lambda t: min(max((t - t0) // width, 0), nbins - 1)
+   keep = []
+   k0 = 0
+   for k in range(1, len(times) + 1):
+      if k < len(times) and binof(times[k]) == binof(times[k0]):
+         continue
+      kmin = min(range(k0, k), key=lambda i: values[i])
+      kmax = max(reversed(range(k0, k)), key=lambda i: values[i])
+      keep.extend(sorted(set([k0, kmin, kmax, k - 1])))
+      k0 = k
+   return [values[i] for i in keep], [times[i] for i in keep]
+
+def bin_series(values, times, t0, t1, nbins):
+   """
+   Summarize the step-function time series values,times over [t0, t1]
+   in nbins equal time bins. The value in effect at the start of each
+   bin counts as part of that bin, so that bins with no new samples
+   still report the value held through them. Returns a dict of arrays
+   with one entry per bin, with keys
+      time - bin start time (EPICS time)
+      min, max - extreme values held during the bin
+      mean - time-weighted average value over the bin
+      last - value in effect at the end of the bin
+      count - number of samples recorded inside the bin
+      duration - time in s during the bin that the value was defined
+   Bins before the first sample have nan values. The arrays are numpy
+   arrays if numpy is available, python lists otherwise.
+   """
+   edges = [t0 + (t1 - t0) * k // nbins for k in range(0, nbins + 1)]
+   if numpy is None:
+      return _bin_series_lists(values, times, edges)
+   times = numpy.asarray(times, dtype=numpy.int64)
+   values = numpy.asarray(values, dtype=numpy.float64)
+   edges = numpy.array(edges, dtype=numpy.int64)
+   if len(times) == 0:
+      return {'time': edges[:-1],
+              'min': numpy.full(nbins, numpy.nan),
+              'max': numpy.full(nbins, numpy.nan),
+              'mean': numpy.full(nbins, numpy.nan),
+              'last': numpy.full(nbins, numpy.nan),
+              'count': numpy.zeros(nbins, dtype=numpy.int64),
+              'duration': numpy.zeros(nbins),
+             }
+   icarry = numpy.searchsorted(times, edges[:-1], side='right') - 1
+   carry = numpy.where(icarry >= 0, values[numpy.maximum(icarry, 0)],
+                       numpy.nan)
+   inside = (times > t0) & (times < t1)
+   ptimes = numpy.concatenate((edges[:-1], times[inside]))
+   pvalues = numpy.concatenate((carry, values[inside]))
+   order = numpy.argsort(ptimes, kind='stable')
+   ptimes = ptimes[order]
+   pvalues = pvalues[order]
+   starts = numpy.flatnonzero(order < nbins)
+   ends = numpy.concatenate((starts[1:], [len(ptimes)]))
+   durations = numpy.diff(numpy.concatenate((ptimes, [t1]))).astype(float)
+   defined = ~numpy.isnan(pvalues)
+   weighted = numpy.add.reduceat(numpy.where(defined, pvalues * durations,
+                                             0), starts)
+   defined_time = numpy.add.reduceat(numpy.where(defined, durations, 0),
+                                     starts)
+   with numpy.errstate(invalid='ignore', divide='ignore'):
+      mean = numpy.where(defined_time > 0, weighted / defined_time,
+                         numpy.nan)
+   return {'time': edges[:-1],
+           'min': numpy.fmin.reduceat(pvalues, starts),
+           'max': numpy.fmax.reduceat(pvalues, starts),
+           'mean': mean,
+           'last': pvalues[ends - 1],
+           'count': ends - starts - 1,
+           'duration': defined_time / epics_second,
+          }
+
+def _bin_series_lists(values, times, edges):
+   """
+   Pure python version of bin_series(), used when numpy is missing.
+   """
+   nan = float('nan')
+   result = {'time': edges[:-1], 'min': [], 'max': [], 'mean': [],
+             'last': [], 'count': [], 'duration': []}
+   i = bisect.bisect_right(times, edges[0])
+   for k in range(0, len(edges) - 1):
+      # samples falling exactly on the bin edge are still counted in
+      # the bin, but the value held before them lasts for no time.
+      j = bisect.bisect_right(times, edges[k], i)
+      value = values[j-1] if j > 0 else nan
+      vmin = vmax = value
+      tprev = edges[k]
+      weighted = 0
+      defined_time = 0
+      count = 0
+      while i < len(times) and times[i] < edges[k+1]:
+         if value == value:
+            weighted += value * (times[i] - tprev)
+            defined_time += times[i] - tprev
+         value = values[i]
+         tprev = times[i]
+         if vmin != vmin or value < vmin:
+            vmin = value
+         if vmax != vmax or value > vmax:
+            vmax = value
+         count += 1
+         i += 1
+      if value == value:
+         weighted += value * (edges[k+1] - tprev)
+         defined_time += edges[k+1] - tprev
+      result['min'].append(vmin)
+      result['max'].append(vmax)
+      result['mean'].append(weighted / defined_time if defined_time else nan)
+      result['last'].append(value)
+      result['count'].append(count)
+      result['duration'].append(defined_time / epics_second)
+   return result
+
+class StepStats:
+   """
+   Accumulator of time-weighted statistics of a step-function series
+   over [t0, t1], where each value holds from its own time until the
+   time of the next sample. The series is fed in time order with
+   add(), in one piece or in consecutive chunks such as stream()
+   yields, and result() returns the statistics. If ranges is given,
+   as a list or iterator of increasing, non-overlapping [tstart, tend]
+   time ranges like search_ranges() returns, only the time inside
+   them counts. Periods before the first sample are not counted.
+   The statistics are those listed for fetch_stats(). Percentiles are
+   computed from the time spent at each distinct value, which is kept
+   in memory for as long as the accumulator lives.
+   """
+
+   def __init__(self, t0, t1, ranges=None, thresholds=(), percentiles=()):
+      self.t0 = t0
+      self.t1 = t1
+      self.gated = ranges is not None
+      self.ranges = None if ranges is None else iter(ranges)
+      self.gate = []
+      self.thresholds = list(thresholds)
+      self.percentiles = list(percentiles)
+      self.tprev = t0
+      self.vprev = float('nan')
+      self.duration = 0.
+      self.integral = 0.
+      self.integral2 = 0.
+      self.vmin = float('nan')
+      self.vmax = float('nan')
+      self.above = [0.] * len(self.thresholds)
+      self.weights = {}
+
+   def add(self, values, times):
+      """
+      Add the next chunk values, times of the series.
+      """
+      if numpy is not None:
+         values = numpy.asarray(values, dtype=numpy.float64)
+         times = numpy.asarray(times, dtype=numpy.int64)
+         i0 = int(numpy.searchsorted(times, self.t0, side='right'))
+         i1 = int(numpy.searchsorted(times, self.t1, side='right'))
+      else:
+         i0 = bisect.bisect_right(times, self.t0)
+         i1 = bisect.bisect_right(times, self.t1)
+      if i0 > 0:
+         self.vprev = float(values[i0 - 1])
+      if i1 <= i0:
+         return
+      values, times = values[i0:i1], times[i0:i1]
+      if numpy is not None:
+         starts = numpy.concatenate(([self.tprev], times[:-1]))
+         segvalues = numpy.concatenate(([self.vprev], values[:-1]))
+      else:
+         starts = [self.tprev] + list(times[:-1])
+         segvalues = [self.vprev] + list(values[:-1])
+      self._accumulate(starts, times, segvalues)
+      self.tprev = times[-1]
+      self.vprev = float(values[-1])
+
+   def result(self):
+      """
+      Close the last step at t1 and return the statistics as a dict.
+      """
+      if self.tprev < self.t1:
+         self._accumulate([self.tprev], [self.t1], [self.vprev])
+         self.tprev = self.t1
+      nan = float('nan')
+      duration = self.duration
+      mean = self.integral / duration if duration > 0 else nan
+      meansq = self.integral2 / duration if duration > 0 else nan
+      result = {'integral': self.integral,
+                'duration': duration,
+                'mean': mean,
+                'rms': math.sqrt(meansq) if duration > 0 else nan,
+                'std': math.sqrt(max(meansq - mean**2, 0))
+                       if duration > 0 else nan,
+                'min': self.vmin,
+                'max': self.vmax,
+                'above': dict(zip(self.thresholds, self.above)),
+                'percentiles': {}}
+      if self.percentiles:
+         levels = sorted(self.weights)
+         cumulative = list(itertools.accumulate(self.weights[v]
+                                                for v in levels))
+         for q in self.percentiles:
+            if duration > 0:
+               k = bisect.bisect_left(cumulative, q / 100. * cumulative[-1])
+               result['percentiles'][q] = levels[min(k, len(levels) - 1)]
+            else:
+               result['percentiles'][q] = nan
+      return result
+
+   def _gated(self, starts, ends):
+      # Return the time in s inside the gate ranges of each of the
+      # intervals [starts[k], ends[k]), using the running total G(t)
+      # of range time before t, so that the overlap is G(end)-G(start).
+      tend = ends[-1]
+      while self.ranges is not None:
+         if self.gate and self.gate[-1][0] > tend:
+            break
+         r = next(self.ranges, None)
+         if r is None:
+            self.ranges = None
+            break
+         self.gate.append((int(r[0]), int(r[1])))
+      tstart = starts[0]
+      while self.gate and self.gate[0][1] < tstart:
+         self.gate.pop(0)
+      if numpy is not None:
+         if not self.gate:
+            return numpy.zeros(len(starts))
+         rs = numpy.array([r[0] for r in self.gate], dtype=numpy.int64)
+         rlen = numpy.array([r[1] - r[0] for r in self.gate],
+                            dtype=numpy.int64)
+         total = numpy.concatenate(([0], numpy.cumsum(rlen)))
+         def G(t):
+            k = numpy.searchsorted(rs, t, side='right') - 1
+            kk = numpy.maximum(k, 0)
+            return numpy.where(k >= 0, total[kk] +
+                               numpy.clip(t - rs[kk], 0, rlen[kk]), 0)
+         starts = numpy.asarray(starts, dtype=numpy.int64)
+         ends = numpy.asarray(ends, dtype=numpy.int64)
+         return (G(ends) - G(starts)) / epics_second
+      rs = [r[0] for r in self.gate]
+      total = [0] + list(itertools.accumulate(r[1] - r[0] for r in self.gate))
+      def G(t):
+         k = bisect.bisect_right(rs, t) - 1
+         if k < 0:
+            return 0
+         r = self.gate[k]
+         return total[k] + min(max(t - r[0], 0), r[1] - r[0])
+      return [(G(b) - G(a)) / epics_second for a, b in zip(starts, ends)]
+
+   def _accumulate(self, starts, ends, values):
+      # Add the steps holding values[k] over [starts[k], ends[k]).
+      if not self.gated:
+         if numpy is not None:
+            weights = (numpy.asarray(ends, dtype=numpy.int64) -
+                       numpy.asarray(starts, dtype=numpy.int64)) / epics_second
+         else:
+            weights = [(b - a) / epics_second for a, b in zip(starts, ends)]
+      else:
+         weights = self._gated(starts, ends)
+      if numpy is not None:
+         values = numpy.asarray(values, dtype=numpy.float64)
+         keep = (weights > 0) & ~numpy.isnan(values)
+         values = values[keep]
+         weights = weights[keep]
+         if len(values) == 0:
+            return
+         self.duration += float(weights.sum())
+         self.integral += float(numpy.dot(values, weights))
+         self.integral2 += float(numpy.dot(values * values, weights))
+         self.vmin = float(numpy.fmin(self.vmin, values.min()))
+         self.vmax = float(numpy.fmax(self.vmax, values.max()))
+         for n, threshold in enumerate(self.thresholds):
+            self.above[n] += float(weights[values > threshold].sum())
+         if self.percentiles:
+            levels, index = numpy.unique(values, return_inverse=True)
+            for v, w in zip(levels.tolist(),
+                            numpy.bincount(index, weights).tolist()):
+               self.weights[v] = self.weights.get(v, 0.) + w
+         return
+      for v, w in zip(values, weights):
+         if w <= 0 or v != v:
+            continue
+         self.duration += w
+         self.integral += v * w
+         self.integral2 += v * v * w
+         if not self.vmin <= v:
+            self.vmin = v
+         if not self.vmax >= v:
+            self.vmax = v
+         for n, threshold in enumerate(self.thresholds):
+            if v > threshold:
+               self.above[n] += w
+         if self.percentiles:
+            self.weights[v] = self.weights.get(v, 0.) + w
+
+def series_stats(values, times, t0, t1, ranges=None, thresholds=(),
+                                        percentiles=()):
+   """
+   Return the time-weighted statistics over [t0, t1] of the step-function
+   series values, times, as described for fetch_stats(). See StepStats
+   for the other arguments.
+   """
+   stats = StepStats(t0, t1, ranges, thresholds, percentiles)
+   stats.add(values, times)
+   return stats.result()
+
+def fetch_stats(descr, t0, dt, cond=None, thresholds=(), percentiles=(),
+                               chunksize=None):
+   """
+   Fetch data for the EPICS variable described in descr over dt seconds
+   from t0, as for fetch, and return its time-weighted statistics as a
+   dict with keys
+      integral - time integral of the value, in value*s
+      duration - time in s over which the value was defined
+      mean, rms, std - time-weighted mean, root mean square and
+                       standard deviation of the value
+      min, max - extreme values held during the interval
+      above - dict mapping each of the given thresholds to the time
+              in s that the value was above it
+      percentiles - dict mapping each of the given percentiles (0-100)
+                    to the value below which the series spent that
+                    percentage of the time
+   If a query condition is given in cond, only the time during which it
+   is true counts. If chunksize is given, the data and the condition
+   are read in streaming mode with chunks of that many samples, so that
+   memory use stays bounded however long the interval.
+   """
+   if isinstance(t0, str):
+      t0 = time_string_to_epics(t0)
+   t0 = int(t0)
+   t1 = t0 + int(dt * epics_second)
+   ranges = None
+   if cond:
+      ranges = compile_query(cond).find(t0, t1, chunksize=chunksize)
+   stats = StepStats(t0, t1, ranges, thresholds, percentiles)
+   if chunksize:
+      for values, times in stream(descr, t0, dt, chunksize):
+         stats.add(values, times)
+   else:
+      stats.add(*fetch(descr, t0, dt))
+   return stats.result()
+
+def integrate(descr, t0, dt, cond=None, chunksize=None):
+   """
+   Return the time integral in value*s of the EPICS variable described
+   in descr over dt seconds from t0, such as the accumulated charge for
+   a beam current, counting only the time when the query condition in
+   cond is true if one is given. See fetch_stats().
+   """
+   return fetch_stats(descr, t0, dt, cond, chunksize=chunksize)['integral']
+
+def search_ranges(query, t0, t1, chunksize=None):
    """
    Searches the archive during the time interval between t0 and t1 for
    time ranges that satisfy the logical condition contained in the
@@ -236,287 +2296,665 @@ def search_ranges(query, t0, t1):
    Parentheses are supported at all levels to change the default
    precedence (python language standard) of operations. The result
    of the query must be a logical value, or the query is invalid.
-   The order of variable lookups to the archive proceeds left-to-
-   right across the expression, so putting the most restrictive
-   or coarse-grained condition variables first will greatly
-   increase the speed of the algorithm.
+   Each epics variable in the query is fetched from the archive once
+   for the full interval, all together with fetch_many(), and the
+   resulting step functions are combined by a single linear merge of
+   their breakpoints, so the cost grows with the total number of
+   archived samples rather than with their product. The query string is
+   compiled once by compile_query() and the result is cached, so
+   repeating the same query costs nothing to re-parse. A malformed
+   query raises ValueError. If chunksize is given, the variables are
+   read with stream() in chunks of that many samples instead of being
+   fetched whole, so that long intervals are scanned in bounded
+   memory and the first ranges are produced right away.
    """
-   if isinstance(t0, str):
-      t0 = time_string_to_epics(t0)
-   if isinstance(t1, str):
-      t1 = time_string_to_epics(t1)
-   if re.match(r"[+\-\.0-9eE]+$", query):
-      yield (t0, t1, float(query))
-      return
-   pquery = parenthesise(query)
-   if not pquery:
-      return
-   elif pquery[0] == ' ':
-      yield from search_ranges(pquery[1:], t0, t1)
-   elif pquery[0] == '!':
-      for r in search_ranges(pquery[1:], t0, t1):
-         yield (r[0], r[1], not r[2])
-      return
-   elif pquery[0] == '-':
-      for r in search_ranges(pquery[1:], t0, t1):
-         yield (r[0], r[1], -r[2])
-      return
-   elif pquery[0] == '+':
-      for r in search_ranges(pquery[1:], t0, t1):
-         yield (r[0], r[1], +r[2])
-      return
-   elif pquery[0] == '(':
-      level = 1
-      for i in range(1, len(pquery)):
-         if pquery[i] == '(':
-            level += 1
-         elif pquery[i] == ')':
-            level -= 1
-         if level == 0:
-            subj_ranges = [r for r in search_ranges(pquery[1:i], t0, t1)]
-            break
-      if level != 0:
-         print("mya.search_ranges error: unbalanced parentheses,"
-               "cannot parse query!")
-         return
-      expr = re.match(r" *([<>=!\+\-\*/\&\|]+) *(.+)", pquery[i+1:])
-      if expr:
-         verb = expr.group(1)
-         pred = expr.group(2)
-      elif subj:
-         subj = subj.group(1)
-         verb = None
-         pred = None
-      else:
-         print("mya.search_ranges error: bad query:", query)
-         return
-   else:
-      subj = re.match(r"([.A-Za-z:_0-9]+)", pquery)
-      expr = re.match(r"([.A-Za-z:_0-9]+) *([<>=!\+\-\*/\&\|]+) *(.+)", pquery)
-      if expr:
-         subj = expr.group(1)
-         verb = expr.group(2)
-         pred = expr.group(3)
-      elif subj:
-         subj = subj.group(1)
-         verb = None
-         pred = None
-      else:
-         print("mya.search_ranges error: bad query:", query)
-         return
-      subj_ranges = []
-      values, times = fetch(subj, t0, (t1 - t0) / epics_second)
-      for i in range(0, len(times) - 1):
-         subj_ranges.append((times[i], times[i+1], values[i]))
-      if len(times) > 0 and times[-1] < t1:
-         subj_ranges.append((times[-1], t1, values[-1]))
-   if len(subj_ranges) == 0:
-      return
-   elif verb == None:
-      for r in subj_ranges:
-         yield (r[0], r[1], r[2])
-      return
-   count = 0
-   for r1 in subj_ranges:
-      count += 1
-      for r2 in search_ranges(pred, r1[0], r1[1]):
-         if verb == "+":
-            value = r1[2] + r2[2]
-         elif verb == "-":
-            value = r1[2] - r2[2]
-         elif verb == "*":
-            value = r1[2] * r2[2]
-         elif verb == "/":
-            value = r1[2] / r2[2]
-         elif verb == "//":
-            value = r1[2] // r2[2]
-         elif verb == "%":
-            value = r1[2] % r2[2]
-         elif verb == "**":
-            value = r1[2] ** r2[2]
-         elif verb == ">":
-            value = r1[2] > r2[2]
-         elif verb == ">=":
-            value = r1[2] >= r2[2]
-         elif verb == "!=":
-            value = r1[2] != r2[2]
-         elif verb == "<":
-            value = r1[2] < r2[2]
-         elif verb == "<=":
-            value = r1[2] <= r2[2]
-         elif verb == "&&":
-            value = r1[2] and r2[2]
-         elif verb == "||":
-            value = r1[2] or r2[2]
-         else:
-            print("mya.search_ranges error: unsupported operator!")
-            return
-         yield (r2[0], r2[1], value)
+   yield from compile_query(query).ranges(t0, t1, chunksize)
 
-def find_ranges(query, t0, t1):
+def find_ranges(query, t0, t1, chunksize=None):
    """
    Runs search_ranges(query, t0, t1) and then compresses the output
    to merge successive intervals with unchanged values, and eliminate
    intervals where the query condition evaluates to False. For details
    regarding the query syntax, see function search_ranges().
    """
-   rsaved = 0
-   for r in search_ranges(query, t0, t1):
-      if r[2] == False:
-         continue
-      elif rsaved and r[0] == rsaved[1]:
-         rsaved[1] = r[1]
-      elif rsaved:
-         yield (rsaved[0], rsaved[1], rsaved[2])
-      rsaved = [r[0], r[1], r[2]]
-   if rsaved:
-      yield (rsaved[0], rsaved[1], rsaved[2])
-
-def parenthesise(query):
-   """
-   Parse an algebraic expression and add parentheses to express the
-   correct operator precedence for python operations, in order from
-   highest to lowest precedence. Multiple operations with the same
-   precedence are processed left-to-right.
-     1. f(args...)           : call to function f()
-     2. +, -                 : unary +, -
-     3. **                   : exponentiation
-     4. *, /, //, %          : multiplication and division
-     5. +, -                 : addition and subtraction
-     6 ==, !=, <, <=, >, >=  : comparison operators
-     7. &&                   : logical and
-     8. ||                   : logical or
-   Support for user-callable functions (precedence 1) is included
-   here for future use, although the query expression parser does
-   not currently recognize any user functions.
-   """
-   bioperators = {'**': 6, '*': 5, '/': 5, '//':5, '%':5,
-                  '+': 4, '-': 4, '==': 3, '!=': 3, '<': 3,
-                  '<=': 3, '>': 3, '>=': 3, '&&': 2, 
-                  '||': 1, ',': 0}
-   pquery = ["",]
-   preced = [0, ]
-   i = -1
-   while i+1 < len(query):
-      i += 1
-      if query[i] == ' ':
-         continue
-      elif query[i] == '(':
-         i0 = i+1
-         level = 1
-         while i+1 < len(query):
-            i += 1
-            if query[i] == '(':
-               level += 1
-            elif query[i] == ')':
-               level -= 1
-            if level == 0:
-               pquery[-1] += '(' + parenthesise(query[i0:i]) + ')'
-               break
-         if level != 0:
-            print("mya.parenthesise error: parenthesis mismatch,"
-                  "cannot parse query!")
-            return ""
-         continue
-      expr = re.match(r"([+\-!]*[.A-Za-z:_0-9]+) *([+\-%/\*\&|=!<>,]+)", query[i:])
-      evar = re.match(r"([+\-!]*[.A-Za-z:_0-9]+) *$", query[i:])
-      efun = re.match(r"[A-Za-z][.A-Za-z:_0-9]*\(", query[i:])
-      if efun:
-         va = '(' + efun.group(0)
-         i += len(efun.group(0))
-         i0 = i
-         level = 1
-         while i+1 < len(query):
-            i += 1
-            if query[i] == '(':
-               level += 1
-            elif query[i] == ')':
-               level -= 1
-            if level == 0:
-               va += parenthesise(query[i0:i]) + '))'
+   yield from compile_query(query).find(t0, t1, chunksize)
+
+_unary_operators = {'+': lambda a: +a,
+                    '-': lambda a: -a,
+                    '!': lambda a: not a,
+                   }
+
+_binary_operators = {'**': (6, lambda a, b: a ** b),
+                     '*': (5, lambda a, b: a * b),
+                     '/': (5, lambda a, b: a / b),
+                     '//': (5, lambda a, b: a // b),
+                     '%': (5, lambda a, b: a % b),
+                     '+': (4, lambda a, b: a + b),
+                     '-': (4, lambda a, b: a - b),
+                     '==': (3, lambda a, b: a == b),
+                     '!=': (3, lambda a, b: a != b),
+                     '<': (3, lambda a, b: a < b),
+                     '<=': (3, lambda a, b: a <= b),
+                     '>': (3, lambda a, b: a > b),
+                     '>=': (3, lambda a, b: a >= b),
+                     '&&': (2, lambda a, b: a and b),
+                     '||': (1, lambda a, b: a or b),
+                    }
+
+_query_token = re.compile(r" *(?:"
+                          r"(?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)"
+                          r"(?:[eE][+\-]?[0-9]+)?(?![.A-Za-z:_0-9]))|"
+                          r"(?P<name>[.A-Za-z:_0-9]+)|"
+                          r"(?P<op>\*\*|//|==|!=|<=|>=|&&|\|\||[-+*/%<>!()]))")
+
+class Query:
+   """
+   Compiled form of a search_ranges() query string. The query is
+   parsed once into an expression tree of nested tuples
+      ('const', value)
+      ('var', name)
+      ('unary', op, operand)
+      ('binary', op, left, right)
+   The operators are, in order from highest to lowest precedence,
+     1. +, -, !              : unary plus, minus and logical not
+     2. **                   : exponentiation
+     3. *, /, //, %          : multiplication and division
+     4. +, -                 : addition and subtraction
+     5. ==, !=, <, <=, >, >= : comparison operators
+     6. &&                   : logical and
+     7. ||                   : logical or
+   with parentheses for grouping, and operators of equal precedence
+   applied left-to-right, except for ** which is right-to-left. The
+   tree can be evaluated over any number of time intervals without
+   touching the original string again. Instances should be obtained
+   through compile_query() so that they are shared between callers
+   asking for the same query.
+   """
+
+   def __init__(self, query):
+      self.query = query
+      self.tokens = self._tokenize(query)
+      self.pos = 0
+      self.tree = self._parse_expr(0)
+      if self.pos < len(self.tokens):
+         self._error("unexpected token '{0}'".format(self.tokens[self.pos][1]))
+      del self.tokens, self.pos
+      self.variables = []
+      self._collect_variables(self.tree)
+
+   def __repr__(self):
+      return "mya.Query({0!r})".format(self.query)
+
+   def _error(self, message):
+      raise ValueError("mya.compile_query error: {0} in query \"{1}\""
+                       .format(message, self.query))
+
+   def _tokenize(self, query):
+      tokens = []
+      i = 0
+      while i < len(query):
+         if query[i:].strip() == "":
+            break
+         token = _query_token.match(query, i)
+         if not token:
+            self._error("cannot parse \"{0}\"".format(query[i:]))
+         for kind in ('number', 'name', 'op'):
+            if token.group(kind) is not None:
+               tokens.append((kind, token.group(kind)))
                break
-         if level != 0:
-            print("mya.parenthesise error: parenthesis mismatch,"
-                  "cannot parse query!")
-            return ""
-         expr = re.match(r" *([+\-%/\*\&|=!<>,]*)", query[i+1:])
-         op = expr.group(1)
-         i += len(op)
-      elif expr:
-         va = expr.group(1)
-         op = expr.group(2)
-      elif evar:
-         va = evar.group(1)
-         op = ""
-      if va and op:
-         if op in bioperators:
-            while bioperators[op] < preced[-1]:
-               preced.pop()
-               pexpr = pquery.pop()
-               va = '(' + pexpr + va + ')'
-            if bioperators[op] > preced[-1]:
-               preced.append(bioperators[op])
-               pquery.append(va + op)
-            elif bioperators[op] == preced[-1]:
-               if preced[-1] > 0:
-                  pquery[-1] = '(' + pquery[-1] + va + ')' + op
-               else:
-                  pquery[-1] += va + op
+         i = token.end()
+      return tokens
+
+   def _next(self):
+      if self.pos < len(self.tokens):
+         return self.tokens[self.pos]
+      return (None, None)
+
+   def _parse_expr(self, min_preced):
+      """
+      Precedence-climbing parser for binary operators, with the
+      precedence table listed for Query, as in _binary_operators. All
+      operators associate left-to-right except **, which associates
+      right-to-left.
+      """
+      left = self._parse_unary()
+      while True:
+         kind, op = self._next()
+         if kind != 'op' or op not in _binary_operators:
+            return left
+         preced = _binary_operators[op][0]
+         if preced < min_preced:
+            return left
+         self.pos += 1
+         if op == '**':
+            right = self._parse_expr(preced)
          else:
-            print("mya.parenthesise error: operator {0} not supported,",
-                  "cannot parse query!".format(expr.group(2)))
-            return ""
-         i += len(expr.group(0)) - 1
-         continue
-      elif va:
-         pquery[-1] += va
-         break
-      print("mya.parenthesise error: query parsing error #2,",
-            "cannot continue!")
+            right = self._parse_expr(preced + 1)
+         left = ('binary', op, left, right)
+
+   def _parse_unary(self):
+      kind, token = self._next()
+      if kind == 'op' and token in _unary_operators:
+         self.pos += 1
+         return ('unary', token, self._parse_unary())
+      return self._parse_atom()
+
+   def _parse_atom(self):
+      kind, token = self._next()
+      self.pos += 1
+      if kind == 'number':
+         return ('const', float(token))
+      elif kind == 'name':
+         if self._next() == ('op', '('):
+            self._error("unsupported function {0}()".format(token))
+         return ('var', token)
+      elif token == '(':
+         tree = self._parse_expr(0)
+         if self._next() != ('op', ')'):
+            self._error("unbalanced parentheses")
+         self.pos += 1
+         return tree
+      elif kind is None:
+         self._error("unexpected end of expression")
+      self._error("unexpected token '{0}'".format(token))
+
+   def _collect_variables(self, node):
+      if node[0] == 'var':
+         if not node[1] in self.variables:
+            self.variables.append(node[1])
+      else:
+         for child in node[2:]:
+            self._collect_variables(child)
+
+   def ranges(self, t0, t1, chunksize=None):
+      """
+      Evaluate the query over the time interval between t0 and t1,
+      yielding a sequence of tuples (tstart, tend, value) that tile
+      the interval. See search_ranges() for details.
+      """
+      if isinstance(t0, str):
+         t0 = time_string_to_epics(t0)
+      if isinstance(t1, str):
+         t1 = time_string_to_epics(t1)
+      tstart = time.perf_counter()
+      count = 0
+      if chunksize:
+         for r in self._stream_ranges(t0, t1, chunksize):
+            count += 1
+            yield r
+      else:
+         fetched = fetch_many(self.variables, t0, (t1 - t0) / epics_second)
+         series = {}
+         for name in self.variables:
+            series[name] = self._step_series(fetched[name], t0, t1)
+         starts, values = self._steps(self.tree, t0, series)
+         count = len(starts)
+         for i in range(0, len(starts)):
+            tend = starts[i+1] if i+1 < len(starts) else t1
+            yield (starts[i], tend, values[i])
+      metrics.record_search(self.query, calls=1,
+                            fetches=len(self.variables), ranges=count,
+                            time=time.perf_counter() - tstart)
+
+   def ranges_nested(self, t0, t1):
+      """
+      Reference implementation of ranges() that evaluates the right
+      operand of every binary operator separately inside each interval
+      of the left operand, fetching the right-hand variables again
+      each time. Much slower than ranges(), kept for benchmarking.
+      """
+      if isinstance(t0, str):
+         t0 = time_string_to_epics(t0)
+      if isinstance(t1, str):
+         t1 = time_string_to_epics(t1)
+      tstart = time.perf_counter()
+      count = 0
+      for r in self._ranges(self.tree, t0, t1):
+         count += 1
+         yield r
+      metrics.record_search(self.query, calls=1, ranges=count,
+                            time=time.perf_counter() - tstart)
+
+   def find(self, t0, t1, chunksize=None):
+      """
+      Evaluate the query over the time interval between t0 and t1,
+      yielding only the merged intervals where the query is true.
+      See find_ranges() for details.
+      """
+      rsaved = 0
+      for r in self.ranges(t0, t1, chunksize):
+         if r[2] == False:
+            continue
+         elif rsaved and r[0] == rsaved[1] and r[2] == rsaved[2]:
+            rsaved[1] = r[1]
+            continue
+         elif rsaved:
+            yield (rsaved[0], rsaved[1], rsaved[2])
+         rsaved = [r[0], r[1], r[2]]
+      if rsaved:
+         yield (rsaved[0], rsaved[1], rsaved[2])
+
+   def _stream_ranges(self, t0, t1, chunksize):
+      """
+      Streaming version of ranges(), which reads every variable with
+      stream() and combines the steps lazily as they arrive.
+      """
+      dt = (t1 - t0) / epics_second
+      iters = {}
+      for name in self.variables:
+         count = self._count_variable(self.tree, name)
+         chunks = stream(name, t0, dt, chunksize)
+         iters[name] = list(itertools.tee(_stream_steps(chunks, t0, t1),
+                                          count))
+      steps = self._iter_steps(self.tree, t0, iters)
+      step = next(steps, None)
+      while step is not None:
+         following = next(steps, None)
+         tend = following[0] if following is not None else t1
+         yield (step[0], tend, step[1])
+         step = following
+
+   def _count_variable(self, node, name):
+      if node[0] == 'var':
+         return 1 if node[1] == name else 0
+      elif node[0] == 'const':
+         return 0
+      return sum(self._count_variable(child, name) for child in node[2:])
+
+   def _iter_steps(self, node, t0, iters):
+      """
+      Evaluate the expression tree under node as an iterator over the
+      (tstart, value) steps of its step function, taking one of the
+      iterators in iters for each variable occurrence.
+      """
+      if node[0] == 'const':
+         return iter([(t0, node[1])])
+      elif node[0] == 'var':
+         return iters[node[1]].pop()
+      elif node[0] == 'unary':
+         func = _unary_operators[node[1]]
+         return _merge_step_iters(self._iter_steps(node[2], t0, iters),
+                                  iter([(t0, None)]),
+                                  lambda a, b: func(a))
+      func = _binary_operators[node[1]][1]
+      return _merge_step_iters(self._iter_steps(node[2], t0, iters),
+                               self._iter_steps(node[3], t0, iters), func)
+
+   def _ranges(self, node, t0, t1):
+      metrics.record_search(self.query, recursion=1)
+      if node[0] == 'const':
+         yield (t0, t1, node[1])
+      elif node[0] == 'var':
+         metrics.record_search(self.query, fetches=1)
+         values, times = fetch(node[1], t0, (t1 - t0) / epics_second)
+         for i in range(0, len(times)):
+            tstart = max(times[i], t0)
+            tend = times[i+1] if i+1 < len(times) else t1
+            tend = min(tend, t1)
+            if tstart < tend or (tstart == tend == t1 and i+1 == len(times)):
+               yield (tstart, tend, values[i])
+      elif node[0] == 'unary':
+         func = _unary_operators[node[1]]
+         for r in self._ranges(node[2], t0, t1):
+            yield (r[0], r[1], func(r[2]))
+      else:
+         func = _binary_operators[node[1]][1]
+         for r1 in self._ranges(node[2], t0, t1):
+            for r2 in self._ranges(node[3], r1[0], r1[1]):
+               yield (r2[0], r2[1], func(r1[2], r2[2]))
+
+   def _step_series(self, series, t0, t1):
+      """
+      Convert the values, times pair in series for the interval [t0, t1]
+      into a step function, a pair of lists (starts, values) where
+      values[i] holds from starts[i] until the next start, clipped to
+      [t0, t1].
+      """
+      values, times = series
+      if len(times) == 0:
+         return [], []
+      values, times = slice_series(values, times, t0, t1)
+      if numpy is not None and isinstance(times, numpy.ndarray):
+         values = values.tolist()
+         times = times.tolist()
+      if len(times) > 1 and times[-1] == t1 and t1 > t0:
+         values = values[:-1]
+         times = times[:-1]
+      return [max(times[0], t0)] + times[1:], values
+
+   def _steps(self, node, t0, series):
+      """
+      Evaluate the expression tree under node as a step function,
+      using the pre-fetched variable step functions in series.
+      """
+      if node[0] == 'const':
+         return [t0], [node[1]]
+      elif node[0] == 'var':
+         return series[node[1]]
+      elif node[0] == 'unary':
+         func = _unary_operators[node[1]]
+         starts, values = self._steps(node[2], t0, series)
+         return _merge_steps(starts, [func(v) for v in values], [], [], None)
+      func = _binary_operators[node[1]][1]
+      sa, va = self._steps(node[2], t0, series)
+      sb, vb = self._steps(node[3], t0, series)
+      return _merge_steps(sa, va, sb, vb, func)
+
+def _merge_steps(sa, va, sb, vb, func):
+   """
+   Combine two step functions (sa, va) and (sb, vb) into a new step
+   function whose value is func(va, vb) at every time where both are
+   defined, walking the two lists of breakpoints in a single pass.
+   If func is None, (sa, va) is returned with adjacent steps of equal
+   value merged. Both inputs must have increasing breakpoints.
+   """
+   if func is None:
+      starts = []
+      values = []
+      for i in range(0, len(sa)):
+         if i == 0 or va[i] != values[-1]:
+            starts.append(sa[i])
+            values.append(va[i])
+      return starts, values
+   if len(sa) == 0 or len(sb) == 0:
+      return [], []
+   tstart = max(sa[0], sb[0])
+   i = bisect.bisect_right(sa, tstart) - 1
+   j = bisect.bisect_right(sb, tstart) - 1
+   na = len(sa) - 1
+   nb = len(sb) - 1
+   starts = [tstart]
+   values = [func(va[i], vb[j])]
+   while i < na or j < nb:
+      ta = sa[i+1] if i < na else math.inf
+      tb = sb[j+1] if j < nb else math.inf
+      if ta <= tb:
+         i += 1
+         tnext = ta
+      if tb <= ta:
+         j += 1
+         tnext = tb
+      value = func(va[i], vb[j])
+      if value != values[-1]:
+         starts.append(tnext)
+         values.append(value)
+   return starts, values
+
+def _stream_steps(chunks, t0, t1):
+   """
+   Turn a sequence of values, times chunks into an iterator over the
+   (tstart, value) steps of the series clipped to [t0, t1].
+   """
+   pending = None
+   for values, times in chunks:
+      for i in range(0, len(times)):
+         if times[i] <= t0:
+            pending = (t0, values[i])
+            continue
+         elif times[i] >= t1:
+            break
+         if pending is not None:
+            yield pending
+            pending = None
+         yield (times[i], values[i])
+   if pending is not None:
+      yield pending
+
+def _merge_step_iters(ia, ib, func):
+   """
+   Lazy version of _merge_steps(), combining two iterators over
+   (tstart, value) steps into an iterator over the steps of func
+   applied to both.
+   """
+   sa = next(ia, None)
+   sb = next(ib, None)
+   if sa is None or sb is None:
       return
-   while len(pquery) > 1:
-      preced.pop()
-      pexpr = pquery.pop()
-      pquery[-1] = '(' + pquery[-1] + '(' + pexpr + '))'
-   while len(pquery[0]) > 0 and pquery[0][0] == '(':
-      level = 1
-      for i in range(1, len(pquery[0])):
-         if pquery[0][i] == '(':
-            level += 1
-         elif pquery[0][i] == ')':
-            level -= 1
-         if level == 0:
-            if i+1 == len(pquery[0]):
-               pquery[0] = pquery[0][1:-1]
-            else:
-               level = -1
-               break
-      if level < 0:
-         break
-   return pquery[0]
+   na = next(ia, None)
+   nb = next(ib, None)
+   tstart = max(sa[0], sb[0])
+   while na is not None and na[0] <= tstart:
+      sa, na = na, next(ia, None)
+   while nb is not None and nb[0] <= tstart:
+      sb, nb = nb, next(ib, None)
+   value = func(sa[1], sb[1])
+   yield (tstart, value)
+   while na is not None or nb is not None:
+      ta = na[0] if na is not None else math.inf
+      tb = nb[0] if nb is not None else math.inf
+      if ta <= tb:
+         sa, na = na, next(ia, None)
+      if tb <= ta:
+         sb, nb = nb, next(ib, None)
+      following = func(sa[1], sb[1])
+      if following != value:
+         value = following
+         yield (min(ta, tb), value)
+
+@functools.lru_cache(maxsize=256)
+def compile_query(query):
+   """
+   Parse a search_ranges() query string into a Query object that can
+   be evaluated repeatedly with its ranges(t0, t1) and find(t0, t1)
+   methods. Compiled queries are cached by query string, so calling
+   this again with the same string returns the same object. A
+   malformed query raises ValueError.
+   """
+   return Query(query)
+
+class MySQLBackend:
+   """
+   Database backend that reaches the archive servers through the
+   proxy with MySQLdb. A database backend provides connect(host),
+   returning a DB-API connection to archive server host, the
+   OperationalError exception class raised on a lost connection,
+   and stream_cursor, the cursor class to pass to con.cursor() for
+   reading large results without holding them in memory.
+   """
+
+   def __init__(self):
+      import MySQLdb
+      import MySQLdb.cursors
+      self.MySQLdb = MySQLdb
+      self.OperationalError = MySQLdb.OperationalError
+      self.stream_cursor = MySQLdb.cursors.SSCursor
+
+   def connect(self, host):
+      dbuser = "myapi"
+      dbpasswd = "MYA"
+      return self.MySQLdb.connect(host=dbproxy, port=port[host],
+                                  user=dbuser, passwd=dbpasswd,
+                                  db=dbname)
+
+class ROOTBackend:
+   """
+   Plot backend that draws with ROOT. A plot backend provides
+   plot(times, values, title), drawing the series with times in s
+   from the first sample, and returning the graph object.
+   """
+
+   def __init__(self):
+      import ROOT
+      self.ROOT = ROOT
+
+   def plot(self, times, values, title):
+      graph = self.ROOT.TGraph(len(times), times, values)
+      graph.SetTitle(title)
+      graph.GetXaxis().SetTitle("epoch time/s")
+      graph.Draw('AL')
+      c1 = self.ROOT.gROOT.FindObject("c1")
+      c1.Update()
+      return graph
+
+# Registry of backends by kind ('db' or 'plot') and name, each entry
+# being a class or other callable that creates the backend, or the
+# dotted "module:attribute" path of one. Backends are only created,
+# and their modules imported, when first used, so that importing mya
+# stays fast. The backend used for each kind is named in backend_use.
+backends = {'db': {'mysql': MySQLBackend},
+            'plot': {'root': ROOTBackend}}
+backend_use = {'db': 'mysql', 'plot': 'root'}
+_backend_instances = {}
+
+def register_backend(kind, name, factory, use=False):
+   """
+   Add backend factory under name to the registry for kind, and make
+   it the one in use if use is true.
+   """
+   backends.setdefault(kind, {})[name] = factory
+   _backend_instances.pop((kind, name), None)
+   if use:
+      use_backend(kind, name)
+
+def use_backend(kind, name):
+   """
+   Select the registered backend name for kind.
+   """
+   if not name in backends.get(kind, {}):
+      raise ValueError("mya.use_backend error: no {0} backend named {1}"
+                       .format(kind, name))
+   backend_use[kind] = name
+   if kind == 'db':
+      with _db_lock:
+         db.clear()
+
+def backend(kind):
+   """
+   Return the backend in use for kind, creating it on first use.
+   """
+   name = backend_use[kind]
+   key = (kind, name)
+   if not key in _backend_instances:
+      factory = backends[kind][name]
+      if isinstance(factory, str):
+         module, attr = factory.split(":")
+         factory = getattr(importlib.import_module(module), attr)
+      _backend_instances[key] = factory()
+   return _backend_instances[key]
 
 def connect(host):
    """
-   Open a connection to mysql server host.
+   Open and return a new connection to archive server host, using
+   the database backend.
+   """
+   return backend('db').connect(host)
+
+class ConnectionPool:
+   """
+   Pool of up to size connections to mysql server host, opened on
+   demand with connect() and shared between threads. A connection
+   that raises an error while in use is closed rather than returned
+   to the pool, so that the next user gets a fresh one.
+   """
+
+   def __init__(self, host, size):
+      self.host = host
+      self.size = size
+      self.idle = []
+      self.lock = threading.Lock()
+      self.slots = threading.BoundedSemaphore(size)
+
+   @contextlib.contextmanager
+   def connection(self):
+      """
+      Context manager that borrows a connection from the pool, waiting
+      if all size connections are already in use.
+      """
+      with self.slots:
+         with self.lock:
+            con = self.idle.pop() if self.idle else None
+         if con is None:
+            con = connect(self.host)
+         try:
+            yield con
+         except BaseException:
+            try:
+               con.close()
+            except Exception:
+               pass
+            raise
+         with self.lock:
+            self.idle.append(con)
+
+   def close(self):
+      """
+      Close all idle connections in the pool.
+      """
+      with self.lock:
+         for con in self.idle:
+            try:
+               con.close()
+            except Exception:
+               pass
+         self.idle = []
+
+_db_lock = threading.Lock()
+
+def pool(host):
+   """
+   Return the connection pool for mysql server host, creating it on
+   first use.
+   """
+   with _db_lock:
+      if not host in db:
+         db[host] = ConnectionPool(host, pool_size)
+      return db[host]
+
+def execute(host, sql, args=None):
+   """
+   Run the sql statement on mysql server host with a connection from
+   its pool, and return the column descriptions and all result rows.
+   If the connection turns out to have been dropped by the server,
+   the idle connections of the pool are most likely stale too, so
+   they are all closed and the statement is retried once on a new
+   connection.
+   """
+   for attempt in (1, 2):
+      tstart = time.perf_counter()
+      try:
+         with pool(host).connection() as con:
+            with _query_context(host, sql):
+               cur = con.cursor()
+               cur.execute(sql, args)
+               result = cur.description, cur.fetchall()
+         metrics.record_query(host, time.perf_counter() - tstart,
+                              len(result[1]), _rows_nbytes(*result))
+         return result
+      except backend('db').OperationalError:
+         metrics.record_query(host, time.perf_counter() - tstart, error=True)
+         if attempt == 2:
+            raise
+         report("execute", "warning", "lost connection to {0},"
+                " reconnecting...".format(host), host=host)
+         pool(host).close()
+
+_executor = None
+
+def executor():
+   """
+   Return the thread pool used for concurrent archive queries,
+   creating it on first use with max_workers threads.
    """
-   dbuser = "myapi"
-   dbpasswd = "MYA"
-   db[host] = MySQLdb.connect(host=dbproxy, port=port[host],
-                              user=dbuser, passwd=dbpasswd,
-                              db=dbname)
+   global _executor
+   with _db_lock:
+      if _executor is None:
+         _executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+      return _executor
 
 def time_string_to_epics(datetime_string, gmt=False):
    """
    Converts a date+time string in format yyyy-mm-dd HH:MM[:SS[+0.X]]
    into an EPICS timestamp value (long int).
    """
-   tsec = datetime.datetime.strptime(datetime_string, "%Y-%m-%d %H:%M:%S")
+   import pytz
+   tsec = datetime.datetime.strptime(datetime_string.partition("+")[0],
+                                     "%Y-%m-%d %H:%M:%S")
    epoch = datetime.datetime(1970,1,1)
    epoch = pytz.utc.localize(epoch, is_dst=None)
    if gmt:
       tsec = pytz.utc.localize(tsec, is_dst=None)
    else:
-      tsec_local = tzlocal.localize(tsec, is_dst=None)
+      tsec_local = _tzlocal().localize(tsec, is_dst=None)
       tsec = tsec_local.astimezone(pytz.utc)
    plus = datetime_string.find("+") + 1
    tfrac = 0
@@ -532,6 +2970,7 @@ def time_epics_to_string(epics_time, fraction=0, gmt=False):
    format "yyyy-mm-dd HH:MM:SS", or "yyy-mm-dd HH:MM:SS+0.X" if fraction
    argument is non-zero, where X is fraction of a second.
    """
+   import pytz
    tepoch = epics_time // epics_second
    tfrac = (epics_time % epics_second) / float(epics_second)
    epoch = datetime.datetime(1970,1,1)
@@ -541,8 +2980,143 @@ def time_epics_to_string(epics_time, fraction=0, gmt=False):
    if gmt:
       ttime = ttime_utc
    else:
-      ttime = ttime_utc.astimezone(tzlocal)
+      ttime = ttime_utc.astimezone(_tzlocal())
    tstring = ttime.strftime("%Y-%m-%d %H:%M:%S")
    if fraction:
       tstring += '+' + str(tfrac)
    return tstring
+
+def _tzlocal():
+   """
+   Return the pytz time zone object for the local time zone, importing
+   pytz on first use.
+   """
+   import pytz
+   return pytz.timezone(timezone)
+
+def __getattr__(name):
+   if name == "tzlocal":
+      return _tzlocal()
+   raise AttributeError("module 'mya' has no attribute '{0}'".format(name))
+
+def _utc_offsets(gmt):
+   """
+   Return a table of the UTC offsets of the local time zone tzlocal,
+   or of UTC if gmt is true, as a pair of lists (transitions, offsets)
+   where offsets[i] seconds is the offset in effect from POSIX time
+   transitions[i] until the next transition. See _zone_offsets().
+   """
+   if gmt:
+      return [-(1 << 62)], [0]
+   return _zone_offsets(timezone)
+
+@functools.lru_cache(maxsize=None)
+def _zone_offsets(zone):
+   """
+   Return the (transitions, offsets) table of _utc_offsets() for the
+   named time zone. It is built once per zone from the pytz transition
+   data, so that converting many times needs no per-value pytz calls,
+   and changing mya.timezone picks up the table of the new zone.
+   """
+   import pytz
+   tz = pytz.timezone(zone)
+   if not hasattr(tz, '_utc_transition_times'):
+      return [-(1 << 62)], [0]
+   epoch = datetime.datetime(1970,1,1)
+   transitions = [int((t - epoch).total_seconds())
+                  for t in tz._utc_transition_times]
+   offsets = [int(info[0].total_seconds())
+              for info in tz._transition_info]
+   transitions[0] = -(1 << 62)
+   return transitions, offsets
+
+def times_epics_to_posix(epics_times):
+   """
+   Vectorized conversion of a sequence of EPICS timestamps into POSIX
+   times in seconds since 1970-01-01 UTC, returned as a float64 numpy
+   array, or as a list of floats if numpy is not available.
+   """
+   if numpy is None:
+      return [t / epics_second for t in epics_times]
+   return numpy.asarray(epics_times, dtype=numpy.int64) / epics_second
+
+def times_epics_to_datetime64(epics_times, gmt=False):
+   """
+   Vectorized conversion of a sequence of EPICS timestamps into a
+   numpy datetime64[ns] array, expressed in local wall-clock time or
+   in UTC if gmt is true. Requires numpy.
+   """
+   epics_times = numpy.asarray(epics_times, dtype=numpy.int64)
+   tepoch = epics_times // epics_second
+   nanosec = (epics_times % epics_second) * 1000000000 // epics_second
+   if not gmt:
+      transitions, offsets = _utc_offsets(gmt)
+      index = numpy.searchsorted(transitions, tepoch, side='right') - 1
+      tepoch = tepoch + numpy.asarray(offsets)[index]
+   return (tepoch.astype('datetime64[s]').astype('datetime64[ns]') +
+           nanosec.astype('timedelta64[ns]'))
+
+def times_epics_to_string(epics_times, fraction=0, gmt=False):
+   """
+   Vectorized version of time_epics_to_string, converting a sequence
+   of EPICS timestamps into a list of strings in the same format.
+   Local time is computed from a precomputed table of the daylight
+   saving transitions of tzlocal instead of calling pytz per value.
+   """
+   if numpy is None:
+      transitions, offsets = _utc_offsets(gmt)
+      epoch = datetime.datetime(1970,1,1)
+      tstrings = []
+      for epics_time in epics_times:
+         tepoch = epics_time // epics_second
+         offset = offsets[bisect.bisect_right(transitions, tepoch) - 1]
+         ttime = epoch + datetime.timedelta(seconds=tepoch + offset)
+         tstrings.append(ttime.strftime("%Y-%m-%d %H:%M:%S"))
+   else:
+      epics_times = numpy.asarray(epics_times, dtype=numpy.int64)
+      seconds = times_epics_to_datetime64(epics_times, gmt)
+      seconds = seconds.astype('datetime64[s]')
+      tstrings = [s.replace('T', ' ') for s in
+                  numpy.datetime_as_string(seconds, unit='s').tolist()]
+   if fraction:
+      for i in range(0, len(tstrings)):
+         tfrac = (epics_times[i] % epics_second) / float(epics_second)
+         tstrings[i] += '+' + str(float(tfrac))
+   return tstrings
+
+def times_string_to_epics(datetime_strings, gmt=False):
+   """
+   Vectorized version of time_string_to_epics, converting a sequence
+   of date+time strings into EPICS timestamps, returned as an int64
+   numpy array, or as a list if numpy is not available. Local times
+   that are ambiguous at the end of daylight saving time are taken
+   as standard time, and those skipped at its start are moved forward
+   by one hour, rather than raising an error as the scalar version does.
+   """
+   transitions, offsets = _utc_offsets(gmt)
+   local_starts = [transitions[i] + offsets[i] for i in range(0, len(offsets))]
+   if numpy is None:
+      epoch = datetime.datetime(1970,1,1)
+      result = []
+      for datetime_string in datetime_strings:
+         tstring, plus, tfrac = datetime_string.partition("+")
+         tsec = datetime.datetime.strptime(tstring, "%Y-%m-%d %H:%M:%S")
+         tlocal = int((tsec - epoch).total_seconds())
+         offset = offsets[bisect.bisect_right(local_starts, tlocal) - 1]
+         tfrac = float(tfrac) if plus else 0
+         result.append((tlocal - offset) * epics_second +
+                       int(math.floor(tfrac * epics_second)))
+      return result
+   if len(datetime_strings) == 0:
+      return numpy.zeros(0, dtype=numpy.int64)
+   parts = numpy.char.partition(numpy.asarray(datetime_strings, dtype=str),
+                                "+")
+   tlocal = numpy.char.replace(parts[:,0], " ", "T")
+   tlocal = tlocal.astype('datetime64[s]').astype(numpy.int64)
+   index = numpy.searchsorted(local_starts, tlocal, side='right') - 1
+   tepoch = tlocal - numpy.asarray(offsets)[index]
+   tfrac = numpy.zeros(len(tepoch))
+   hasfrac = parts[:,2] != ""
+   tfrac[hasfrac] = parts[:,2][hasfrac].astype(float)
+   return (tepoch * epics_second +
+           numpy.floor(tfrac * epics_second).astype(numpy.int64))
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+#
+# mya_bench.py - timing benchmarks for the mya module, run against
+#                synthetic time series so that no connection to the
+#                archive servers is needed.
+#
+# The default benchmark suite generates a local fake archive in SQLite
+# files with the same channels, groups, members and table_<chan_id>
+# layout as the archive servers, installs it as the mya database
+# backend, and reports latency percentiles, throughput and peak memory
+# for fetch, fetch_many, find_ranges, filter_cond and pyshell.iterate
+# in cache-hit and cache-miss scenarios.
+#
+# sample usage:
+#   ./mya_bench.py
+#   ./mya_bench.py --channels 16 --rate 1 --length 86400 --latency 2
+#   ./mya_bench.py --scenario fetch-miss --scenario fetch-hit
+#   ./mya_bench.py --merge --samples 20000 --query "A > 5 && B < 3"
+#   ./mya_bench.py --startup --max-startup 200
+
+import os
+import io
+import sys
+import math
+import argparse
+import contextlib
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import mya
+
+def synthesize(name, t0, t1, samples, levels=10, seed=None):
+   """
+   Generate a random step-function series for variable name with the
+   given number of samples spread over [t0, t1], and install it in
+   the mya cache so that mya.fetch() serves it without a database.
+   """
+   rand = random.Random(seed)
+   times = sorted(rand.randrange(t0, t1) for i in range(0, samples))
+   times[0] = t0
+   times[-1] = t1
+   values = [float(rand.randrange(0, levels)) for t in times]
+   mya.epics_cache['mya descriptors'][name] = {'name': name,
+                                               'chan_id': 0,
+                                               'host': 'synthetic'}
+   mya.series_cache.store(name, t0, t1, values, times)
+
+def bench(func, repeat=3):
+   """
+   Run func() repeat times and return the best wall-clock time in s.
+   """
+   best = None
+   for i in range(0, repeat):
+      tstart = time.perf_counter()
+      func()
+      elapsed = time.perf_counter() - tstart
+      if best is None or elapsed < best:
+         best = elapsed
+   return best
+
+class FakeArchive:
+   """
+   Local stand-in for the archive servers, holding one SQLite file
+   <host>.sqlite per server in directory path. The first host holds
+   the channels, groups and members directory tables, and the
+   table_<chan_id> data tables are spread over all hosts. It works as
+   a mya database backend, see mya.MySQLBackend, translating the %s
+   parameter style of MySQLdb, and optionally sleeping for latency s
+   per query to imitate the round trip through the proxy.
+   """
+
+   OperationalError = sqlite3.OperationalError
+   stream_cursor = None
+
+   def __init__(self, path, hosts=("opsmya0", "opsmya1"), latency=0):
+      self.path = path
+      self.hosts = list(hosts)
+      self.latency = latency
+      self.queries = 0
+
+   def connect(self, host):
+      return FakeConnection(self, os.path.join(self.path, host + ".sqlite"))
+
+   def generate(self, nchannels, t0, t1, rate, seed=0):
+      """
+      Create nchannels channels with scaler-like series over [t0, t1],
+      sampled at random times at an average of rate samples/s, with
+      chan_ids taken from tables.list and groups from groups.list
+      where those snapshots are found. Returns the channel names.
+      """
+      here = os.path.dirname(os.path.abspath(__file__))
+      chan_ids = _read_chan_ids(os.path.join(here, "tables.list"))
+      chan_ids = chan_ids[:nchannels]
+      chan_ids += range(1, nchannels - len(chan_ids) + 1)
+      groups = _read_group_names(os.path.join(here, "groups.list"))
+      groups = groups[:max(nchannels // 4, 1)] or ["scalers"]
+      rand = random.Random(seed)
+      cons = {host: sqlite3.connect(os.path.join(self.path, host + ".sqlite"))
+              for host in self.hosts}
+      directory = cons[self.hosts[0]]
+      directory.execute("create table channels (chan_id integer primary key,"
+                        " name text, type integer, adel real, size integer,"
+                        " clip real, active integer, request integer,"
+                        " alert integer, host text, backup integer)")
+      directory.execute("create table `groups` (group_id integer primary key,"
+                        " name text, comment text, user_id integer,"
+                        " active integer, expire integer, parent_id integer)")
+      directory.execute("create table members (group_id integer,"
+                        " chan_id integer)")
+      directory.executemany("insert into `groups` values"
+                            " (?, ?, 'core', 1, 1, NULL, ?)",
+                            [(k + 1, name, k + 1)
+                             for k, name in enumerate(groups)])
+      names = []
+      for n, chan_id in enumerate(chan_ids):
+         name = "BENCH:SCALER{0:03d}".format(n)
+         host = self.hosts[n % len(self.hosts)]
+         directory.execute("insert into channels values"
+                           " (?, ?, 6, NULL, 1, NULL, 1, 1, 0, ?, 0)",
+                           (chan_id, name, host))
+         directory.execute("insert into members values (?, ?)",
+                           (n % len(groups) + 1, chan_id))
+         cons[host].execute("create table table_{0}".format(chan_id) +
+                            " (time bigint primary key, val1 double)")
+         cons[host].executemany("insert into table_{0}".format(chan_id) +
+                                " values (?, ?)",
+                                _scaler_rows(rand, t0, t1, rate))
+         names.append(name)
+      for con in cons.values():
+         con.commit()
+         con.close()
+      return names
+
+class FakeConnection:
+   def __init__(self, archive, filename):
+      self.archive = archive
+      self.con = sqlite3.connect(filename, check_same_thread=False)
+
+   def cursor(self, cursorclass=None):
+      return FakeCursor(self)
+
+   def close(self):
+      self.con.close()
+
+class FakeCursor:
+   def __init__(self, connection):
+      self.connection = connection
+      self.cur = connection.con.cursor()
+      self.description = None
+
+   def execute(self, sql, args=None):
+      archive = self.connection.archive
+      archive.queries += 1
+      if archive.latency:
+         time.sleep(archive.latency)
+      self.cur.execute(sql.replace("%s", "?"), args or ())
+      self.description = self.cur.description
+
+   def fetchone(self):
+      return self.cur.fetchone()
+
+   def fetchmany(self, size):
+      return self.cur.fetchmany(size)
+
+   def fetchall(self):
+      return self.cur.fetchall()
+
+   def close(self):
+      self.cur.close()
+
+def _read_chan_ids(path):
+   if not os.path.exists(path):
+      return []
+   with open(path) as fin:
+      return [int(line[6:]) for line in fin if line.startswith("table_")]
+
+def _read_group_names(path):
+   if not os.path.exists(path):
+      return []
+   with open(path) as fin:
+      fin.readline()
+      return [line.split("\t")[1] for line in fin if "\t" in line]
+
+def _scaler_rows(rand, t0, t1, rate):
+   # Rows of a counting-rate series sampled at exponentially distributed
+   # intervals, drifting slowly and occasionally dropping to zero.
+   t = t0 - int(rand.expovariate(rate) * mya.epics_second) - 1
+   level = rand.uniform(100, 1000)
+   rows = []
+   while t <= t1:
+      level = max(level * rand.gauss(1, 0.01), 1.)
+      value = 0. if rand.random() < 0.02 else rand.gauss(level, level**0.5)
+      rows.append((t, value))
+      t += int(rand.expovariate(rate) * mya.epics_second) + 1
+   return rows
+
+# Modules that import mya must not load until they are needed.
+heavy_modules = ("ROOT", "MySQLdb", "pytz")
+
+def startup_time(repeat=5):
+   """
+   Measure the time to import mya in a fresh python interpreter, as
+   the best time to run "import mya" less the best time to start an
+   interpreter that imports nothing. Returns the time in s and the
+   list of heavy_modules that the import loaded.
+   """
+   here = os.path.dirname(os.path.abspath(__file__))
+   probe = ("import mya, sys; print(' '.join(m for m in {0!r}"
+            " if m in sys.modules))".format(heavy_modules))
+   def run(code):
+      return subprocess.run([sys.executable, "-c", code], cwd=here,
+                            stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+   loaded = run(probe).split()
+   base = bench(lambda: run("pass"), repeat)
+   full = bench(lambda: run("import mya"), repeat)
+   return max(full - base, 0), loaded
+
+def scenarios(names, t0, t1):
+   """
+   Return the list of benchmark scenarios over the fake archive channels
+   names and the interval [t0, t1], as tuples (name, setup, run) where
+   setup() prepares the caches before each timed call of run(), which
+   returns the number of samples or cells it produced.
+   """
+   import pyshell
+   dt = (t1 - t0) / mya.epics_second
+   query = "{0} > 500 && ({1} < 800 || {2} == 0)".format(*names[:3])
+   def cold():
+      mya.series_cache.clear()
+   def warm():
+      mya.fetch(names[0], t0, dt)
+   def fetch():
+      return len(mya.fetch(names[0], t0, dt)[1])
+   def fetch_many():
+      return sum(len(series[1])
+                 for series in mya.fetch_many(names, t0, dt).values())
+   def find_ranges():
+      return len(list(mya.find_ranges(query, t0, t1)))
+   def filter_warm():
+      mya.fetch_many(names[:4], t0, dt)
+   def filter_cond():
+      return len(mya.fetch(names[3 % len(names)], t0, dt, cond=query)[1])
+   def iterate_cold():
+      pyshell.iterate_cache.clear()
+      pyshell.code_cache.clear()
+   def iterate():
+      shape = [64, 32, 8]
+      pyshell.iterate('lambda i,j,k:"BENCH:SCALER%03d[%d]" % (i//4, j*8+k)',
+                      [0, 0, 0], shape)
+      return shape[0] * shape[1] * shape[2]
+   return [("fetch-miss", cold, fetch),
+           ("fetch-hit", warm, fetch),
+           ("fetch_many-miss", cold, fetch_many),
+           ("find_ranges-miss", cold, find_ranges),
+           ("find_ranges-hit", filter_warm, find_ranges),
+           ("filter_cond-hit", filter_warm, filter_cond),
+           ("iterate", iterate_cold, iterate),
+          ]
+
+def percentile(sorted_values, q):
+   """
+   Return the q'th percentile (0-100) of a sorted list, interpolating
+   between neighboring entries.
+   """
+   x = (len(sorted_values) - 1) * q / 100.
+   k = int(math.floor(x))
+   if k + 1 >= len(sorted_values):
+      return sorted_values[-1]
+   return sorted_values[k] + (sorted_values[k+1] - sorted_values[k]) * (x - k)
+
+def measure(setup, run, repeat):
+   """
+   Time repeat calls of run(), each after a call of setup(), and then
+   measure the peak memory allocated during one more such call.
+   Returns the sorted latencies in s, the count returned by run(),
+   and the peak memory in bytes.
+   """
+   latencies = []
+   with contextlib.redirect_stdout(io.StringIO()):
+      for i in range(0, repeat):
+         setup()
+         tstart = time.perf_counter()
+         count = run()
+         latencies.append(time.perf_counter() - tstart)
+      setup()
+      tracemalloc.start()
+      run()
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+   return sorted(latencies), count, peak
+
+def suite(args):
+   """
+   Generate the fake archive and run the benchmark scenarios.
+   """
+   t0 = mya.opsmya_start + 86400 * mya.epics_second
+   t1 = t0 + int(args.length * mya.epics_second)
+   with tempfile.TemporaryDirectory() as path:
+      archive = FakeArchive(path, latency=args.latency / 1000.)
+      tstart = time.perf_counter()
+      names = archive.generate(args.channels, t0, t1, args.rate)
+      print("fake archive: {0} channels, {1} samples each at {2} Hz,"
+            " generated in {3:.1f} s".format(args.channels,
+            int(args.rate * args.length), args.rate,
+            time.perf_counter() - tstart))
+      mya.register_backend('db', 'fake', lambda: archive, use=True)
+      try:
+         print("{0:18s} {1:>9s} {2:>9s} {3:>9s} {4:>12s} {5:>10s}".format(
+               "scenario", "p50/ms", "p90/ms", "p99/ms", "items/s",
+               "peak/MB"))
+         for name, setup, run in scenarios(names, t0, t1):
+            if args.scenario and not name in args.scenario:
+               continue
+            latencies, count, peak = measure(setup, run, args.repeat)
+            p50 = percentile(latencies, 50)
+            print("{0:18s} {1:9.2f} {2:9.2f} {3:9.2f} {4:12.0f} {5:10.2f}"
+                  .format(name, p50 * 1000, percentile(latencies, 90) * 1000,
+                          percentile(latencies, 99) * 1000,
+                          count / p50 if p50 > 0 else 0, peak / 1e6))
+      finally:
+         mya.use_backend('db', 'mysql')
+         mya.series_cache.clear()
+
+def merge(args):
+   """
+   Compare the sweep-merge and nested evaluation of a query over
+   synthetic series installed directly in the cache.
+   """
+   t0 = mya.opsmya_start
+   t1 = t0 + 86400 * mya.epics_second
+   query = mya.compile_query(args.query)
+   for seed, name in enumerate(query.variables):
+      synthesize(name, t0 - mya.epics_second, t1 + mya.epics_second,
+                 args.samples, seed=seed)
+   sweep = bench(lambda: list(query.ranges(t0, t1)), args.repeat)
+   nested = bench(lambda: list(query.ranges_nested(t0, t1)), args.repeat)
+   print("query: {0}".format(args.query))
+   print("samples per variable: {0}".format(args.samples))
+   print("sweep-merge ranges(): {0:.4f} s".format(sweep))
+   print("nested ranges_nested(): {0:.4f} s".format(nested))
+   print("speedup: {0:.1f}x".format(nested / sweep))
+
+def main():
+   parser = argparse.ArgumentParser(description="benchmark mya on a local"
+                                    " synthetic archive")
+   parser.add_argument("--channels", type=int, default=8,
+                       help="number of channels in the fake archive")
+   parser.add_argument("--rate", type=float, default=0.2,
+                       help="average samples/s per channel")
+   parser.add_argument("--length", type=float, default=86400,
+                       help="length of the archived series in s")
+   parser.add_argument("--latency", type=float, default=0,
+                       help="simulated round trip time per query in ms")
+   parser.add_argument("--scenario", action="append",
+                       help="run only this scenario (may be repeated)")
+   parser.add_argument("--merge", action="store_true",
+                       help="compare sweep-merge and nested query"
+                            " evaluation instead")
+   parser.add_argument("--samples", type=int, default=2000,
+                       help="with --merge, number of samples per variable")
+   parser.add_argument("--query", default="A > 5 && B < 3 || C == 1",
+                       help="with --merge, the query to evaluate")
+   parser.add_argument("--repeat", type=int, default=None,
+                       help="number of timing repetitions")
+   parser.add_argument("--startup", action="store_true",
+                       help="measure the time to import mya instead")
+   parser.add_argument("--max-startup", type=float, default=None,
+                       help="with --startup, fail if the import takes"
+                            " longer than this many ms")
+   args = parser.parse_args()
+
+   if args.startup:
+      elapsed, loaded = startup_time(args.repeat or 5)
+      print("import mya: {0:.1f} ms".format(elapsed * 1000))
+      if loaded:
+         print("heavy modules loaded at import: {0}".format(" ".join(loaded)))
+      if args.max_startup is not None and (elapsed * 1000 > args.max_startup
+                                           or loaded):
+         print("startup time check failed")
+         sys.exit(1)
+   elif args.merge:
+      args.repeat = args.repeat or 3
+      merge(args)
+   else:
+      args.repeat = args.repeat or 20
+      suite(args)
+
+if __name__ == "__main__":
+   main()
@@ -1,47 +1,374 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
+#
+# pyshell.py - python expression server for the scalers.js backend
+#
+# Requests arrive on stdin one per line, as JSON objects of the form
+#    {"id": <request id>, "expr": "<python expression>"}
+# and are evaluated concurrently by a pool of worker processes, so
+# responses may be written to stdout in any order, one per line, as
+#    {"id": <request id>, "result": "<str of value>"}
+# or {"id": <request id>, "error": "PROGRAM ERROR"}
+# A request line that is not a JSON object is evaluated directly and
+# the result printed as plain text, for interactive use.
+#
+# Expressions are parsed and checked against whitelists of python
+# syntax and attribute names before they are compiled, see check_expr
+# and safe_attributes, and are evaluated with only the builtins in
+# safe_builtins and the functions listed in safe_globals in scope.
+#
+# Usage: pyshell.py [-n <workers>]
+#    The number of workers can also be set in environment variable
+#    PYSHELL_WORKERS, default 4. If PYSHELL_STORE names a directory,
+#    each worker opens it as the persistent mya archive store. If
+#    PYSHELL_DIRECTORY names an archive deployment (ops or history),
+#    each worker loads the mya channel directory index for it.
+#    PYSHELL_LOG_MODE sets mya.log_mode in the workers, for example
+#    to json for structured diagnostics on stderr.
+
+import os
 import sys
-import re
+import ast
+import base64
+import json
+import array
+import atexit
+import builtins
+import logging
+import logging.handlers
+import itertools
+import threading
+import collections
+import multiprocessing
+
+try:
+    import mya
+except ImportError:
+    mya = None
+
+# The browser sends the same iterate() programs over and over for
+# each scaler map layout, so keep the most recent results, and the
+# compiled code of the lambda expressions, in bounded LRU caches.
+iterate_cache_size = 256
+iterate_cache = collections.OrderedDict()
+code_cache = collections.OrderedDict()
+
+def lru_get(cache, key):
+    value = cache.pop(key, None)
+    if value is not None:
+        cache[key] = value
+    return value
+
+def lru_put(cache, key, value):
+    cache[key] = value
+    while len(cache) > iterate_cache_size:
+        cache.popitem(last=False)
+
+# Only these kinds of syntax node may appear in an expression, which
+# rules out statements, imports, assignment expressions and the like.
+# Store only occurs in the targets of comprehensions.
+safe_nodes = (
+    ast.Expression, ast.Load, ast.Store, ast.Constant, ast.Name, ast.Attribute,
+    ast.Call, ast.keyword, ast.Starred, ast.Lambda, ast.arguments,
+    ast.arg, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.Tuple, ast.List, ast.Set, ast.Dict, ast.Subscript, ast.Slice,
+    ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp,
+    ast.comprehension, ast.JoinedStr, ast.FormattedValue,
+    ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+) + tuple(getattr(ast, node) for node in ("Index", "Num", "Str")
+          if hasattr(ast, node))
+
+# Only the public methods and properties of the builtin value types
+# may be looked up as attributes. Objects such as generators, frames
+# and code objects have attributes without a leading _ (gi_frame,
+# f_back, f_globals) that lead back to the module globals, so those
+# must not be reachable. Format fields like {0.attr} or {0[key]} reach
+# attributes that the syntax check never sees, and the format string
+# can be assembled at run time, so the str.format methods may not be
+# called at all.
+safe_attributes = frozenset(
+    name for t in (bool, int, float, complex, str, bytes, list, tuple,
+                   dict, set, frozenset, range)
+    for name in dir(t)
+    if not name.startswith('_')) - {"format", "format_map"}
+
+safe_builtins = {name: getattr(builtins, name)
+                 for name in ("abs", "all", "any", "bool", "chr", "dict",
+                              "divmod", "enumerate", "float", "format",
+                              "hex", "int", "len", "list", "map", "max",
+                              "min", "oct", "ord", "pow", "range", "repr",
+                              "reversed", "round", "set", "sorted", "str",
+                              "sum", "tuple", "zip")}
+safe_builtins.update({"None": None, "True": True, "False": False})
+
+def check_expr(expr):
+    # Parse expr and raise ValueError unless it uses only whitelisted
+    # syntax and attributes, with no access to names beginning with _.
+    tree = ast.parse(expr, "<request>", "eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, safe_nodes):
+            raise ValueError("Unsafe request detected, " +
+                             type(node).__name__ + " is not allowed")
+        name = (node.id if isinstance(node, ast.Name) else
+                node.attr if isinstance(node, ast.Attribute) else
+                node.arg if isinstance(node, ast.arg) else None)
+        if name and name.startswith('_'):
+            raise ValueError("Unsafe request detected, " +
+                             name + " is not allowed")
+        if (isinstance(node, ast.Attribute) and
+                node.attr not in safe_attributes):
+            raise ValueError("Unsafe request detected, " +
+                             node.attr + " is not allowed")
+    return tree
+
+def compile_expr(expr):
+    # Check and compile expr once, then reuse the code object.
+    code = lru_get(code_cache, expr)
+    if code is None:
+        code = compile(check_expr(expr), "<request>", "eval")
+        lru_put(code_cache, expr, code)
+    return code
 
 def iterate(expr, index0, index1):
-    f = eval(expr)
-    dim = len(index0)
-    names = {'none': 0}
-    index = [index0[i] for i in range(0, dim)]
-    nameTable = tabulate(f, dim-1, index, index0, index1, names)
-    json = '{"names":['
-    for key, value in sorted(names.iteritems(), key=lambda (k,v): (v,k)):
-        if value > 1:
-            json += ',"' + key + '"'
-        elif value == 1:
-            json += '"' + key + '"'
-    json += '],"nameTable":' + str(nameTable) + '}'
-    json += '\n'
+    key = (expr, tuple(index0), tuple(index1))
+    json = lru_get(iterate_cache, key)
+    if json is None:
+        json = tabulate_json(expr, index0, index1)
+        lru_put(iterate_cache, key, json)
     return json
 
-def tabulate(f, dim, index, index0, index1, names):
-    newrow = [0] * index1[dim]
-    if dim > 0:
-        for i in range (index0[dim], index1[dim]):
-            index[dim] = i
-            newrow[i] = tabulate(f, dim-1, index, index0, index1, names)
-    else:
-        for i in range (index0[0], index1[0]):
-            index[0] = i
-            name = f(*index)
+def tabulate_json(expr, index0, index1):
+    f = eval(compile_expr(expr), safe_globals)
+    names = {'none': 0}
+    table = tabulate(f, index0, index1, names)
+    names = sorted(names, key=names.get)[1:]
+    return ('{"names":' + json.dumps(names) + ',"nameTable":' +
+            ''.join(encode_table(table, index1)) + '}\n')
+
+def tabulate(f, index0, index1, names):
+    # Evaluate f over the index grid index0 <= index < index1 and
+    # return the flat table of name ids, with dimension 0 varying
+    # fastest and shape index1, cells below index0 being left at 0.
+    # New names are numbered in order of first appearance, scanning
+    # the last dimension slowest.
+    dim = len(index0)
+    strides = [1] * dim
+    for d in range(1, dim):
+        strides[d] = strides[d-1] * index1[d-1]
+    table = array.array('l', [0]) * (strides[-1] * index1[-1])
+    outer = [range(index0[d], index1[d]) for d in range(dim-1, 0, -1)]
+    inner = range(index0[0], index1[0])
+    for outer_index in itertools.product(*outer):
+        index = outer_index[::-1]
+        base = sum(index[d-1] * strides[d] for d in range(1, dim))
+        row = list(map(f, inner, *[itertools.repeat(i) for i in index]))
+        for name in row:
             if not name in names:
                 names[name] = len(names)
-            newrow[i] = names[name]
-    return newrow
+        table[base + inner.start:base + inner.stop] = array.array('l',
+                                                      map(names.get, row))
+    return table
+
+def encode_table(table, shape):
+    # Generate the json text of the flat table as nested lists, with
+    # the last dimension outermost, one row of dimension 0 at a time.
+    # If any dimension is 0 the table is empty, but the dimensions
+    # outside of it still give nested lists, as in [[], [], []].
+    if 0 in shape:
+        yield empty_table(shape)
+        return
+    n0 = shape[0]
+    for r in range(0, len(table) // n0):
+        opening = 1
+        closing = 1
+        count = r
+        for d in range(1, len(shape)):
+            if count % shape[d] == 0:
+                opening += 1
+            else:
+                break
+            count //= shape[d]
+        count = r
+        for d in range(1, len(shape)):
+            if count % shape[d] == shape[d] - 1:
+                closing += 1
+            else:
+                break
+            count //= shape[d]
+        yield ((',' if r > 0 else '') + '[' * opening +
+               ','.join(map(str, table[r*n0:(r+1)*n0])) + ']' * closing)
+
+def empty_table(shape):
+    d = len(shape) - 1
+    if shape[d] == 0:
+        return '[]'
+    return '[' + ','.join([empty_table(shape[:d])] * shape[d]) + ']'
+
+def ranges(query, t0, t1):
+    # Return as json the list of [tstart, tend] time ranges between
+    # t0 and t1 during which the mya query condition is true.
+    return json.dumps([[int(r[0]), int(r[1])]
+                       for r in mya.find_ranges(query, t0, t1)])
 
-while True:
-    req = raw_input()
-    open("pyshell.log", "a").write(req + '\n')
+def series(name, t0, dt=0, npoints=None, encoding="json", compress=False):
+    # Return the values and times of EPICS variable name fetched from
+    # the archive, see mya.fetch, as json, or with encoding "float64"
+    # or "float32" as the base64 text of a binary columnar payload,
+    # see mya.encode_series.
+    values, times = mya.fetch(name, t0, dt, npoints=npoints)
+    if encoding != "json":
+        return encode_payload({name: (values, times)}, encoding, compress)
+    return json.dumps({"values": [float(v) for v in values],
+                       "times": [int(t) for t in times]})
+
+def series_many(names, t0, dt=0, npoints=None, encoding="json",
+                compress=False):
+    # Same as series, for a list of EPICS variable names fetched
+    # together with mya.fetch_many, returned as a json object or a
+    # binary payload with one entry per name.
+    fetched = mya.fetch_many(names, t0, dt)
+    if npoints:
+        for name in fetched:
+            fetched[name] = mya.decimate(fetched[name][0], fetched[name][1],
+                                         npoints)
+    if encoding != "json":
+        return encode_payload(fetched, encoding, compress)
+    return json.dumps({name: {"values": [float(v) for v in values],
+                              "times": [int(t) for t in times]}
+                       for name, (values, times) in fetched.items()})
+
+def encode_payload(fetched, encoding, compress):
+    payload = mya.encode_series(fetched, encoding, compress)
+    return base64.b64encode(payload).decode("ascii")
+
+def channels(pattern, mode="prefix", limit=100):
+    # Return as json the sorted list of channel names matching pattern,
+    # see mya.ChannelDirectory.search.
+    return json.dumps(mya.directory.search(pattern, mode, limit))
+
+def group(name, recursive=True):
+    # Return as json the sorted list of channel names in archive group
+    # name, see mya.ChannelDirectory.group_channels.
+    return json.dumps(mya.directory.group_channels(name, recursive))
+
+# Each worker process keeps its own mya metrics, so the workers
+# publish their snapshots in worker_metrics, a dict shared through a
+# multiprocessing manager and keyed by process id, whenever a request
+# has changed them.
+worker_metrics = None
+published_changes = None
+
+def publish_metrics():
+    global published_changes
+    if worker_metrics is None or mya is None:
+        return
+    if mya.metrics.changes != published_changes:
+        published_changes = mya.metrics.changes
+        worker_metrics[os.getpid()] = mya.metrics.snapshot()
+
+def metrics():
+    # Return as json the mya metrics snapshots of all worker processes
+    # merged into one, see mya.Metrics and mya.merge_snapshots, with
+    # the process ids of the workers included listed under "workers".
+    publish_metrics()
+    if worker_metrics is None:
+        snapshots = {os.getpid(): mya.metrics.snapshot()}
+    else:
+        snapshots = dict(worker_metrics)
+    merged = mya.merge_snapshots(list(snapshots.values()))
+    merged['workers'] = sorted(snapshots)
+    return json.dumps(merged)
+
+safe_globals = {'__builtins__': safe_builtins,
+                'iterate': iterate,
+                'ranges': ranges,
+                'series': series,
+                'series_many': series_many,
+                'channels': channels,
+                'group': group,
+                'metrics': metrics}
+
+def evaluate(req):
+    return str(eval(compile_expr(req), safe_globals))
+
+def handle(reqid, req):
+    # Evaluate one framed request in a worker process and return
+    # the framed response line.
     try:
-        if re.search(r"__", req):
-            raise ValueError("Unsafe request detected, rejecting request!")
-        else:
-            print eval(req, {__builtins__:None}, {'iterate': iterate})
-    except:
-        print "PROGRAM ERROR"
-    sys.stdout.flush()
-    model = False
+        return json.dumps({"id": reqid, "result": evaluate(req)})
+    except Exception:
+        return json.dumps({"id": reqid, "error": "PROGRAM ERROR"})
+    finally:
+        publish_metrics()
+
+def init_worker(shared_metrics=None):
+    # Anything the workers print, such as mya diagnostics, must not
+    # be mixed into the responses on stdout.
+    global worker_metrics
+    sys.stdout = sys.stderr
+    worker_metrics = shared_metrics
+    if mya is not None and os.environ.get("PYSHELL_STORE"):
+        mya.open_store(os.environ["PYSHELL_STORE"])
+    if mya is not None and os.environ.get("PYSHELL_LOG_MODE"):
+        mya.log_mode = os.environ["PYSHELL_LOG_MODE"]
+    if mya is not None and os.environ.get("PYSHELL_DIRECTORY"):
+        mya.open_directory(os.environ["PYSHELL_DIRECTORY"])
+
+# Incoming requests are logged to pyshell.log through a buffer that
+# is written out every log_buffer_size lines, and on exit.
+log_buffer_size = 100
+log = logging.getLogger("pyshell")
+
+def open_log(path="pyshell.log"):
+    target = logging.FileHandler(path)
+    target.setFormatter(logging.Formatter("%(message)s"))
+    handler = logging.handlers.MemoryHandler(log_buffer_size,
+                                             flushLevel=logging.ERROR,
+                                             target=target)
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    atexit.register(handler.close)
+
+output_lock = threading.Lock()
+
+def respond(line):
+    with output_lock:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+def serve(nworkers):
+    global worker_metrics
+    manager = multiprocessing.Manager()
+    worker_metrics = manager.dict()
+    pool = multiprocessing.Pool(nworkers, initializer=init_worker,
+                                initargs=(worker_metrics,))
+    while True:
+        try:
+            req = input()
+        except EOFError:
+            break
+        log.info(req)
+        if not req.startswith('{'):
+            try:
+                respond(evaluate(req))
+            except Exception:
+                respond("PROGRAM ERROR")
+            continue
+        try:
+            msg = json.loads(req)
+            reqid = msg['id']
+            expr = msg['expr']
+        except (ValueError, TypeError, KeyError):
+            respond(json.dumps({"id": None, "error": "BAD REQUEST"}))
+            continue
+        pool.apply_async(handle, (reqid, expr), callback=respond)
+    pool.close()
+    pool.join()
+    manager.shutdown()
+
+if __name__ == "__main__":
+    nworkers = int(os.environ.get("PYSHELL_WORKERS", 4))
+    if len(sys.argv) > 2 and sys.argv[1] == "-n":
+        nworkers = int(sys.argv[2])
+    open_log()
+    serve(nworkers)
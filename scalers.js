@@ -78,71 +78,75 @@ var rcdb_pool = mysql.createPool({ connectionLimit: 10, //important
 // spawn a python shell to interpret python expressions
 
 var pyshell = child_process.spawn('./pyshell.py');
+pyshell.stdout.setEncoding('utf8');
+pyshell.stderr.setEncoding('utf8');
 pyshell.stdout.on('data', pyshell_output_listener);
 pyshell.stdout.on('error', pyshell_fault_listener);
 pyshell.stdout.on('close', pyshell_close_listener);
 pyshell.stderr.on('data', pyshell_error_listener);
 pyshell.stderr.on('error', pyshell_fault_listener);
 pyshell.stderr.on('close', pyshell_close_listener);
-var pyshell_queue = [];
+var pyshell_pending = {};
+var pyshell_next_id = 1;
+var pyshell_buffer = "";
 
 function pyshell_query(message) {
     // Send message to the python shell as a command, and return
     // a promise for the response. All communication with the
-    // python shell should take place through this function
-    // properly manage the serialization.
+    // python shell should take place through this function.
+    // Each request is tagged with a unique id and written at once
+    // as a line of json, so that the python shell workers can
+    // process several requests at the same time and answer them
+    // in any order.
 
     return new Promise(function(resolve, reject) {
-        pyshell_queue.push({message: message,
-                            response: "",
-                            resolve: resolve,
-                            reject: reject});
-        if (pyshell_queue.length == 1) {
-            pyshell.stdin.write(message + '\n');
-        }
+        var id = pyshell_next_id++;
+        pyshell_pending[id] = {resolve: resolve,
+                               reject: reject};
+        pyshell.stdin.write(JSON.stringify({id: id, expr: message}) + '\n');
     });
 }
 
 function pyshell_output_listener(data) {
-    // Event listener for stdout responses from the python shell,
-    // passes the response to the first resolve in the queue.
-    // Responses are left open until reception of a nl termination
-    // character. When a response terminates the original promise
-    // is resolved and the next message in the queue is sent, if any.
- 
-    if (pyshell_queue.length == 0) {
-        console.log("unexpected message from pyshell: " + data);
-        return;
-    }
-    pyshell_queue[0].response += data;
-    if (data[data.length - 1] == 0x0a) {
-        pyshell_queue[0].resolve(pyshell_queue[0].response);
-        pyshell_queue.shift();
-        if (pyshell_queue.length > 0) {
-            pyshell.stdin.write(pyshell_queue[0].message + '\n');
+    // Event listener for stdout responses from the python shell.
+    // Responses are lines of json, {"id": id, "result": text} or
+    // {"id": id, "error": text}, that may be split across several
+    // data events. Each complete line resolves or rejects the
+    // promise of the request with the matching id.
+
+    pyshell_buffer += data;
+    var lines = pyshell_buffer.split('\n');
+    pyshell_buffer = lines.pop();
+    for (var i in lines) {
+        if (lines[i].length == 0)
+            continue;
+        var response;
+        try {
+            response = JSON.parse(lines[i]);
+        }
+        catch (err) {
+            console.log("unexpected message from pyshell: " + lines[i]);
+            continue;
+        }
+        var request = pyshell_pending[response.id];
+        if (! request) {
+            console.log("unexpected response from pyshell: " + lines[i]);
+            continue;
         }
+        delete pyshell_pending[response.id];
+        if ('error' in response)
+            request.reject(response.error);
+        else
+            request.resolve(response.result);
     }
 }
 
 function pyshell_error_listener(data) {
-    // Event listener for stderr responses from the python shell,
-    // passes the response to the first resolve in the queue.
-    // Responses are left open until reception of a nl termination
-    // character. When a response terminates the original promise
-    // is resolved and the next message in the queue is sent, if any.
-
-    if (pyshell_queue.length == 0) {
-        console.log("unexpected message from pyshell: " + data);
-        return;
-    }
-    pyshell_queue[0].response += data;
-    if (data[data.length - 1] == 0x0a) {
-        pyshell_queue[0].reject(pyshell_queue[0].response);
-        pyshell_queue.shift();
-        if (pyshell_queue.length > 0) {
-            pyshell.stdin.write(pyshell_queue[0].message + '\n');
-        }
-    }
+    // Event listener for stderr output from the python shell,
+    // which carries diagnostic messages from the workers but
+    // never responses to requests, so just log it.
+
+    console.log("pyshell: " + data);
 }
 
 function pyshell_fault_listener(data) {
@@ -394,6 +398,42 @@ function do_eval_mapstring(req_obj) {
     });
 }
 
+function do_fetch_series(req_obj) {
+    // Fetch the archived series of a comma-separated list of channel
+    // names from the pyshell and return them, as json by default or,
+    // with format=float64 or format=float32, as the binary columnar
+    // payload described in mya.encode_series, zlib compressed if
+    // compress=1 is given. The start time t0 is either an EPICS
+    // timestamp or a local time string yyyy-mm-dd HH:MM:SS, which
+    // is passed to the pyshell as a quoted string.
+
+    const names = (req_obj.query.names)? req_obj.query.names.split(',') : [];
+    var t0 = req_obj.query.t0 || '0';
+    if (/^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$/.test(t0))
+        t0 = JSON.stringify(t0);
+    else if (! /^\d+$/.test(t0))
+        return Promise.resolve({code: 400, type: 'plain',
+                                content: "Bad t0 value " + t0});
+    const dt = parseFloat(req_obj.query.dt) || 0;
+    const npoints = parseInt(req_obj.query.npoints) || 0;
+    var format = req_obj.query.format;
+    if (format != 'float64' && format != 'float32')
+        format = 'json';
+    const compress = (req_obj.query.compress == '1')? 'True' : 'False';
+    var prog = 'series_many(' + JSON.stringify(names) + ',' + t0 + ',' +
+               dt + ',' + (npoints || 'None') + ',"' + format + '",' +
+               compress + ')';
+    return pyshell_query(prog).then(function(result) {
+        if (format == 'json')
+            return {code: 200, content: result, type: 'json'};
+        return {code: 200, content: Buffer.from(result, 'base64'),
+                type: 'binary'};
+    }).catch(function(err) {
+        console.log("Error - " + err);
+        return {code: 500, content: err, type: 'plain'};
+    });
+}
+
 function readFile(filepath, encoding) {
     // Wrap fs.readFile to make it return a promise.
 
@@ -469,7 +509,9 @@ http.createServer(function (req, res) {
     // the handle through which a response is sent.
 
     var send_response = function(result) {
-        res.writeHead(result.code, {'Content-Type': 'text/' + result.type});
+        var content_type = (result.type == 'binary')?
+                           'application/octet-stream' : 'text/' + result.type;
+        res.writeHead(result.code, {'Content-Type': content_type});
         res.end(result.content);
         console.log("sent response in format " + result.type + 
                     " length " + result.content.length.toString())
@@ -489,6 +531,8 @@ http.createServer(function (req, res) {
             do_eval_namestring(req_obj).then(send_response);
         else if (req_obj.query.request == "eval_mapping")
             do_eval_mapstring(req_obj).then(send_response);
+        else if (req_obj.query.request == "fetch_series")
+            do_fetch_series(req_obj).then(send_response);
         else
             send_response(400, "400 Bad Request", "plain");
     }
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+#
+# test_pyshell.py - regression tests for the expression sandbox of
+#                   pyshell.py, run with python3 -m unittest
+#
+
+import unittest
+
+import pyshell
+
+class SandboxTest(unittest.TestCase):
+
+    def assertRejected(self, expr):
+        with self.assertRaises(ValueError):
+            pyshell.evaluate(expr)
+
+    def test_allowed(self):
+        self.assertEqual(pyshell.evaluate("[i*i for i in range(4)]"),
+                         "[0, 1, 4, 9]")
+        self.assertEqual(pyshell.evaluate("'-'.join(str(i) for i in [1, 2])"),
+                         "1-2")
+        self.assertEqual(pyshell.evaluate("'TAGM%03d' % 7 + 'a'.upper()"),
+                         "TAGM007A")
+        self.assertEqual(pyshell.evaluate("{'a': 1}.get('a')"), "1")
+
+    def test_underscore_names(self):
+        self.assertRejected("().__class__")
+        self.assertRejected("__import__('os')")
+        self.assertRejected("_x")
+
+    def test_format_methods(self):
+        self.assertRejected("'{0.__class__}'.format(1)")
+        self.assertRejected("('{0.' + '_' * 2 + 'class__}').format(1)")
+        self.assertRejected("'{x}'.format_map({'x': 1})")
+
+    def test_generator_frames(self):
+        self.assertRejected("[[l.append((l[1].gi_frame.f_back.f_back.f_back"
+                            ".f_globals['os'].getcwd() for z in [0])),"
+                            " list(l[1])] for l in [[0]]]")
+        self.assertRejected("(x for x in [0]).gi_frame")
+        self.assertRejected("(x for x in [0]).gi_code.co_consts")
+        self.assertRejected("(lambda: 0).f_globals")
+
+    def test_other_attributes(self):
+        self.assertRejected("str.mro()")
+        self.assertRejected("iterate.cr_frame")
+        self.assertRejected("iterate.ag_frame")
+        self.assertRejected("iterate.tb_frame")
+
+if __name__ == "__main__":
+    unittest.main()